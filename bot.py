@@ -1,53 +1,530 @@
 #!/usr/bin/env python3
 
+import atexit
+import contextlib
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import subprocess
-import secrets
-import re
 import asyncio
+import functools
 import time
-from collections import defaultdict, deque
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes
+from collections import OrderedDict, defaultdict, deque
+import httpx
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MenuButtonCommands
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.helpers import escape_markdown
 from config import Config
 from database import Database
 from languages import get_text
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Write log records from a background thread so slow stdout/journald never stalls the event loop
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, *logging.root.handlers, respect_handler_level=True)
+logging.root.handlers = [logging.handlers.QueueHandler(_log_queue)]
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# Channel member statuses that count as being in the channel / being an admin
+_PRESENT_STATUSES = frozenset({ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+_ADMIN_STATUSES = frozenset({ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+
+# Channel pin menu message (Persian)
+_PIN_MENU_TEXT = (
+    "🔗 **دریافت پروکسی رایگان MTProxy**\n\n"
+    "🎁 **برای اعضای کانال کاملاً رایگان!**\n\n"
+    "📱 **نحوه دریافت:**\n"
+    "👆 روی دکمه 'دریافت پروکسی' کلیک کنید\n\n"
+    "⚠️ **مهم:** فقط اعضای کانال پروکسی دریافت می‌کنند\n"
+    "🔒 **امنیت:** پروکسی خود را با دیگران به اشتراک نگذارید"
+)
+
+# Admin stats messages, formatted with the counters in WorkingMTProxyBot.stats
+_STATS_TEMPLATE_FA = (
+    "📊 **آمار ربات**\n\n"
+    "👥 **کاربران:** {total_users} فعال\n"
+    "📈 **فعالیت:**\n"
+    "   • عضویت: {joins}\n"
+    "   • خروج: {leaves}\n"
+    "   • پروکسی ایجاد شده: {proxies_created}\n"
+    "   • پروکسی حذف شده: {proxies_removed}\n\n"
+    "⚠️ **مشکلات:**\n"
+    "   • خطاها: {errors}\n"
+    "   • محدود شده: {rate_limited}\n\n"
+    "⏱️ **مدت کار:** {uptime_hours:.1f} ساعت\n"
+    "🔄 **آخرین ریستارت MTProxy:** {since_restart:.1f}s پیش"
+)
+_STATS_TEMPLATE_EN = (
+    "📊 **Bot Statistics**\n\n"
+    "👥 **Users:** {total_users} active\n"
+    "📈 **Activity:**\n"
+    "   • Joins: {joins}\n"
+    "   • Leaves: {leaves}\n"
+    "   • Proxies created: {proxies_created}\n"
+    "   • Proxies removed: {proxies_removed}\n\n"
+    "⚠️ **Issues:**\n"
+    "   • Errors: {errors}\n"
+    "   • Rate limited: {rate_limited}\n\n"
+    "⏱️ **Uptime:** {uptime_hours:.1f} hours\n"
+    "🔄 **Last MTProxy restart:** {since_restart:.1f}s ago"
+)
+
+# Bot commands: (command, handler method, block). Commands that may wait on
+# systemctl don't block dispatch, so a slow restart doesn't stall other chats
+_COMMANDS = (
+    ("start", "start", False),
+    ("menu", "menu", True),
+    ("help", "show_help", True),
+    ("pin", "pin_channel_menu", True),  # Admin-only pin command
+    ("unpin", "unpin_channel_message", True),  # Admin-only unpin command
+    ("stats", "show_stats", True),
+    ("restart_proxy", "restart_mtproxy", False),  # Admin-only MTProxy restart
+    ("reboot_vps", "reboot_vps", False),  # Admin-only VPS reboot
+)
+
+# callback_data prefixes routed to each CallbackQueryHandler (matched with str.startswith)
+_PROXY_CALLBACK_PREFIX = "get_proxy_"
+_MENU_CALLBACK_PREFIXES = ("status_", "create_proxy_", "help", "back_to_menu", "admin_")
+
+# Chat menu button that lists the bot commands
+_MENU_BUTTON = MenuButtonCommands()
+
+# Update kinds with registered handlers (chat_member must be requested explicitly)
+_ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+
+# Characters allowed in a 32-char MTProxy secret (lowercase hex)
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+@functools.lru_cache(maxsize=8)
+def _tls_domain_hex(tls_domain):
+    """Hex-encode a fake-TLS domain for the ee-secret suffix (None if TLS is off)"""
+    if tls_domain and tls_domain != '""':
+        return tls_domain.encode('utf-8').hex().lower()
+    return None
+
+_timestamp_cache = (None, '')  # (epoch second, formatted) of the last _now_str call
+
+def _now_str():
+    """Current local time as 'YYYY-MM-DD HH:MM:SS', formatted at most once per second"""
+    global _timestamp_cache
+    now = int(time.time())
+    if now != _timestamp_cache[0]:
+        _timestamp_cache = (now, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)))
+    return _timestamp_cache[1]
+
+class _SlidingWindowLimiter:
+    """Async limiter that lets at most `limit` calls through per `window` seconds"""
+    
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._times = deque(maxlen=limit)
+        self._lock = asyncio.Lock()
+    
+    async def wait(self):
+        """Wait until another call fits in the window, then record it"""
+        async with self._lock:
+            if len(self._times) == self.limit:
+                delay = self._times[0] + self.window - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._times.append(time.monotonic())
+
+class _AdaptiveTokenBucket:
+    """Token bucket whose refill rate halves on a 429 and creeps back up on success"""
+    
+    def __init__(self, rate, capacity, min_rate=1.0, step=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.step = step
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available, then take it"""
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1
+                self._updated = time.monotonic()
+            self._tokens -= 1
+    
+    def increase(self):
+        self.rate = min(self.max_rate, self.rate + self.step)
+    
+    def decrease(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0
+    
+class _BotRateLimiter(BaseRateLimiter):
+    """Paces every Bot API request (except getUpdates) below Telegram's limits:
+    ~30 requests per second overall, and for sends/edits 1 per second per private
+    chat and 20 per minute per group or channel. Requests answered with 429 are
+    retried after `retry_after`, and network errors with jittered exponential
+    backoff, at most `max_retries` times."""
+    
+    _CHAT_LIMITED_ENDPOINTS = frozenset({
+        'sendMessage', 'editMessageText', 'editMessageReplyMarkup',
+        'pinChatMessage', 'unpinChatMessage', 'unpinAllChatMessages',
+    })
+    
+    def __init__(self, rate=25, capacity=30, max_retries=8, max_chats=1024, backoff_base=0.5, backoff_cap=30):
+        self._bucket = _AdaptiveTokenBucket(rate, capacity)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._chat_limiters = OrderedDict()  # chat_id -> _SlidingWindowLimiter, LRU-bounded
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def _chat_limiter(self, chat_id):
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            limiter = _SlidingWindowLimiter(20, 60) if is_group else _SlidingWindowLimiter(1, 1)
+            self._chat_limiters[chat_id] = limiter
+            if len(self._chat_limiters) > self.max_chats:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+    
+    def _backoff(self, attempt):
+        """Exponential backoff with jitter for transient network failures"""
+        return min(self.backoff_cap, self.backoff_base * 2 ** attempt) + random.uniform(0, 0.3)
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # One per-chat slot per logical request; retries only wait out their backoff
+        chat_id = data.get('chat_id') if endpoint in self._CHAT_LIMITED_ENDPOINTS else None
+        if chat_id is not None:
+            await self._chat_limiter(chat_id).wait()
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._bucket.decrease()
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after
+            except BadRequest as e:
+                # An earlier attempt that timed out may already have applied this edit
+                if attempt and endpoint.startswith('editMessage') and 'message is not modified' in e.message.lower():
+                    return True
+                raise  # Subclass of NetworkError, but never transient
+            except NetworkError as e:
+                # A timed-out sendMessage may already have been delivered; don't send it twice
+                if attempt == self.max_retries or (isinstance(e, TimedOut) and endpoint == 'sendMessage'):
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                self._bucket.increase()
+                return result
+            logger.warning("⏳ Retrying Bot API call: method=%s attempt=%s backoff_s=%.2f",
+                           endpoint, attempt + 1, delay)
+            await asyncio.sleep(delay)
+
+class _Stats:
+    """Bot activity counters, kept as slotted attributes for cheap access"""
+    
+    __slots__ = ('joins', 'leaves', 'proxies_created', 'proxies_removed', 'errors', 'rate_limited')
+    
+    def __init__(self, **counts):
+        for name in self.__slots__:
+            setattr(self, name, counts.get(name, 0))
+    
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class _ChannelMemberHandler(ChatMemberHandler):
+    """ChatMemberHandler that drops updates from chats rejected by chat_filter before dispatch"""
+    __slots__ = ('chat_filter',)
+    
+    def __init__(self, callback, chat_filter, chat_member_types=ChatMemberHandler.CHAT_MEMBER, block=True):
+        super().__init__(callback, chat_member_types, block=block)
+        self.chat_filter = chat_filter
+    
+    def check_update(self, update):
+        return super().check_update(update) and self.chat_filter(update.chat_member.chat)
+
 class WorkingMTProxyBot:
     def __init__(self):
         Config.validate()
         self.config = Config()
         self.db = Database()
         self.service_file = "/etc/systemd/system/MTProxy.service"
+        self._service_cache = None  # (stat_key, config) of last parsed service file
         self.language = self.config.BOT_LANGUAGE
+        self._resolved_channel_id = None  # Numeric channel ID, resolved once
+        
+        # Exact-match callback routes: callback_data -> (handler, requires_admin)
+        self._callback_routes = {
+            'help': (self._show_help_callback, False),
+            'back_to_menu': (self._show_main_menu_callback, False),
+            'admin_pin_menu': (self._handle_admin_pin_callback, True),
+            'admin_unpin_all': (self._handle_admin_unpin_callback, True),
+            'admin_stats': (self._handle_admin_stats_callback, True),
+            'admin_restart_proxy': (self._handle_admin_restart_proxy_callback, True),
+            'admin_reboot_vps': (self._handle_admin_reboot_vps_callback, True),
+            'admin_reboot_confirm': (self._handle_admin_reboot_confirm_callback, True),
+        }
+        
+        # Per-user callback routes: callback_data prefix (before "_<user_id>") -> handler
+        self._callback_prefix_routes = {
+            'status': self._show_status_callback,
+            'create_proxy': self._provide_proxy_via_callback,
+        }
+        
+        # Admin operations that must not run twice at the same time
+        self._admin_op_locks = {
+            op: asyncio.Lock()
+            for op in ('admin_pin_menu', 'admin_unpin_all', 'admin_restart_proxy', 'admin_reboot_confirm')
+        }
+        
+        # Long-running admin callbacks that are scheduled rather than awaited
+        self._background_callbacks = {'admin_restart_proxy'}
+        
+        # Recently handled callback query IDs, so a redelivered update is not run twice
+        self._seen_callbacks = OrderedDict()
+        self.seen_callbacks_size = 4096
+        
+        # Toast shown when acknowledging slow admin callbacks
+        self._callback_ack_keys = {
+            'admin_pin_menu': 'admin_working',
+            'admin_restart_proxy': 'admin_restart_proxy_progress',
+            'admin_reboot_confirm': 'admin_working',
+        }
+        
+        # Short-lived LRU cache of channel member statuses: user_id -> (checked_at, status)
+        self._membership_cache = OrderedDict()
+        self.membership_cache_ttl = 30
+        self.admin_cache_ttl = 60
+        self.membership_cache_size = 4096
+        
+        # Per-user locks serializing proxy creation/removal: user_id -> [lock, users]
+        self._user_locks = {}
+        
+        # LRU cache of active users' secrets for the "get proxy" button: user_id -> secret
+        self._secret_cache = OrderedDict()
+        self._secret_cache_epoch = 0
+        self.secret_cache_size = 4096
+        
+        # Static help texts, rendered once
+        self._help_text = (
+            f"{self.t('help_title')}\n\n"
+            f"{self.t('help_quick_start')}\n"
+            f"{self.t('help_step1')}\n"
+            f"{self.t('help_step2')}\n\n"
+            f"{self.t('help_commands')}\n"
+            f"{self.t('help_start')}\n"
+            f"{self.t('help_menu')}\n"
+            f"{self.t('help_help')}\n\n"
+            f"{self.t('help_security')}\n"
+            f"{self.t('help_unique')}\n"
+            f"{self.t('help_no_share')}\n"
+            f"{self.t('help_stay_channel')}\n\n"
+            f"{self.t('help_tip_menu')}"
+        )
+        self._detailed_help_text = (
+            f"{self.t('detailed_help_title')}\n\n"
+            f"{self.t('detailed_step1')}\n"
+            f"{self.t('detailed_step2')}\n"
+            f"{self.t('detailed_step3')}\n"
+            f"{self.t('detailed_step4')}\n"
+            f"{self.t('detailed_step5')}\n\n"
+            f"{self.t('help_security')}\n"
+            f"{self.t('help_unique')}\n"
+            f"{self.t('help_no_share')}\n"
+            f"{self.t('help_stay_channel')}\n\n"
+            f"{self.t('help_commands')}\n"
+            f"{self.t('help_menu')}\n"
+            f"{self.t('help_start')}"
+        )
+        
+        # "How to connect" block shared by all proxy welcome messages
+        self._connect_steps = "\n".join(
+            self.t(key) for key in ('how_to_connect', 'step_tap_button', 'step_telegram_ask', 'step_connect')
+        )
+        
+        # Other static multi-line messages, rendered once
+        self._welcome_back_text = (
+            f"{self.t('welcome_back')}\n\n"
+            f"{self._connect_steps}\n\n"
+            f"{self.t('stay_in_channel')}\n"
+            f"{self.t('security_notice')}"
+        )
+        self._welcome_new_text = (
+            f"{self.t('welcome_new')}\n\n"
+            f"{self._connect_steps}\n\n"
+            f"{self.t('stay_in_channel')}\n"
+            f"{self.t('security_notice')}"
+        )
+        self._welcome_auto_back_text = (
+            f"{self.t('welcome_auto_back')}\n\n"
+            f"{self._connect_steps}\n\n"
+            f"{self.t('security_notice')}"
+        )
+        self._welcome_auto_new_text = (
+            f"{self.t('welcome_auto_new')}\n\n"
+            f"{self._connect_steps}\n\n"
+            f"{self.t('stay_in_channel')}\n"
+            f"{self.t('security_notice')}"
+        )
+        self._personal_proxy_text = (
+            f"{self.t('personal_proxy')}\n\n"
+            f"{self.t('tap_to_connect')}\n\n"
+            f"{self.t('security_notice_title')}\n"
+            f"{self.t('security_personal')}\n"
+            f"{self.t('security_no_share')}\n"
+            f"{self.t('security_stay_active')}"
+        )
+        self._join_request_text = (
+            f"{self.t('access_required')}\n\n"
+            f"{self.t('join_first')}\n\n"
+            f"👆 {self.t('auto_receive')}"
+        )
+        self._access_required_text = (
+            f"{self.t('access_required')}\n\n"
+            f"{self.t('join_first')}\n\n"
+            f"{self.t('auto_receive')}"
+        )
         
         # Rate limiting and load management
-        self.user_rate_limit = defaultdict(lambda: deque(maxlen=10))  # Track user actions
+        self.rate_limit_actions = 5  # Max actions per window
+        self.rate_limit_window = 60  # Window length in seconds
+        # Per-user ring of last action timestamps, with the insertion counter in the last slot
+        self.user_rate_limit = defaultdict(lambda: [0.0] * self.rate_limit_actions + [0])
         self.mtproxy_operations = asyncio.Queue(maxsize=50)  # Queue MTProxy operations
-        self.operation_lock = asyncio.Lock()  # Prevent concurrent MTProxy operations
+        self._mtproxy_drainer = None  # Task applying queued operations in batches
+        self._housekeeping_tasks = []  # Periodic tasks started in post_init
+        self._reboot_task = None  # Pending reboot countdown (/reboot_vps or the confirm button)
+        self.operation_lock = asyncio.Lock()  # Serializes service file writes and MTProxy restarts
         self.last_mtproxy_restart = 0  # Track last restart time
         self.restart_cooldown = 5  # Minimum seconds between restarts
         
+        # Pre-generated proxy secrets, refilled with one urandom read at a time
+        self._secret_pool = deque()
+        self.secret_pool_size = 256
+        
+        # Public IP is looked up once and reused for an hour
+        self._public_ip = None
+        self._public_ip_fetched_at = 0
+        self._public_ip_failed_at = 0
+        self._public_ip_lookup = None  # In-flight lookup shared by concurrent callers
+        self.public_ip_ttl = 3600
+        self.public_ip_retry_delay = 60  # After a failed lookup, use the fallback this long
+        
+        # Active user count shown in stats, cached briefly across repeated clicks
+        self._active_count = 0
+        self._active_count_fetched_at = 0
+        self.active_count_ttl = 30
+        
+        # Keyboards that are the same for every user, built on first use
+        self._keyboards = {}
+        
         # Statistics
-        self.stats = {
-            'joins': 0,
-            'leaves': 0,
-            'proxies_created': 0,
-            'proxies_removed': 0,
-            'errors': 0,
-            'rate_limited': 0
-        }
+        # Counters are persisted in the database so they survive restarts
+        self.stats = _Stats(**self.db.get_stats())
+        self._saved_stats = self.stats.as_dict()
     
     def t(self, key: str, **kwargs) -> str:
         """Get translated text"""
         return get_text(key, self.language, **kwargs)
     
+    def _static_keyboard(self, key, build) -> InlineKeyboardMarkup:
+        """Get a keyboard that doesn't depend on the user, building it once"""
+        markup = self._keyboards.get(key)
+        if markup is None:
+            markup = self._keyboards[key] = build()
+        return markup
+    
+    def _get_proxy_keyboard(self, user_id: int) -> InlineKeyboardMarkup:
+        """Build keyboard with the user's 'get proxy' button"""
+        return InlineKeyboardMarkup([[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user_id}")]])
+    
+    def _connect_proxy_keyboard(self, proxy_link: str) -> InlineKeyboardMarkup:
+        """Build keyboard with the 'connect' button for a proxy link"""
+        return InlineKeyboardMarkup([[InlineKeyboardButton(self.t('btn_connect_proxy'), url=proxy_link)]])
+    
+    def _pin_menu_keyboard(self, bot_username: str) -> InlineKeyboardMarkup:
+        """Get (cached) keyboard for the pinned channel menu"""
+        return self._static_keyboard(('pin_menu', bot_username), lambda: InlineKeyboardMarkup(
+            [[InlineKeyboardButton("🔗 دریافت پروکسی", url=f"https://t.me/{bot_username}?start=proxy")]]))
+    
+    def _back_to_menu_keyboard(self, label_key: str) -> InlineKeyboardMarkup:
+        """Get (cached) single-button keyboard leading back to the main menu"""
+        return self._static_keyboard(('back_to_menu', label_key), lambda: InlineKeyboardMarkup(
+            [[InlineKeyboardButton(self.t(label_key), callback_data="back_to_menu")]]))
+    
+    def _main_menu_keyboard(self, user_id: int, has_proxy: bool, is_admin: bool) -> InlineKeyboardMarkup:
+        """Build main menu keyboard for a channel member"""
+        if has_proxy:
+            keyboard = [
+                [InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user_id}")],
+                [InlineKeyboardButton(self.t('btn_proxy_status'), callback_data=f"status_{user_id}")],
+                [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
+            ]
+        else:
+            keyboard = [
+                [InlineKeyboardButton(self.t('btn_create_proxy'), callback_data=f"create_proxy_{user_id}")],
+                [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
+            ]
+        
+        # Admin controls for channel admins
+        if is_admin:
+            keyboard.append([InlineKeyboardButton("📌 پین منوی کانال", callback_data="admin_pin_menu")])
+            keyboard.append([InlineKeyboardButton("🗑️ حذف همه پین‌ها", callback_data="admin_unpin_all")])
+            keyboard.append([InlineKeyboardButton("📊 آمار ربات", callback_data="admin_stats")])
+            keyboard.append([InlineKeyboardButton("🔄 راه‌اندازی مجدد پروکسی", callback_data="admin_restart_proxy")])
+            keyboard.append([InlineKeyboardButton("🚨 راه‌اندازی مجدد سرور", callback_data="admin_reboot_vps")])
+        
+        return InlineKeyboardMarkup(keyboard)
+    
+    def _join_channel_keyboard(self, with_help: bool) -> InlineKeyboardMarkup:
+        """Get (cached) keyboard with the join-channel button (and optionally help)"""
+        def build():
+            keyboard = [[InlineKeyboardButton(self.t('btn_join_channel'), url=f"https://t.me/{self.config.CHANNEL_USERNAME}")]]
+            if with_help:
+                keyboard.append([InlineKeyboardButton(self.t('btn_help'), callback_data="help")])
+            return InlineKeyboardMarkup(keyboard)
+        return self._static_keyboard(('join_channel', with_help), build)
+    
+    def _status_keyboard(self, user_id: int) -> InlineKeyboardMarkup:
+        """Build keyboard shown under an active proxy's status"""
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user_id}")],
+            [InlineKeyboardButton(self.t('btn_back_menu'), callback_data="back_to_menu")]
+        ])
+    
+    def _reboot_confirm_keyboard(self) -> InlineKeyboardMarkup:
+        """Get (cached) confirm/cancel keyboard for the VPS reboot dialog"""
+        return self._static_keyboard('reboot_confirm', lambda: InlineKeyboardMarkup([
+            [InlineKeyboardButton(self.t('btn_confirm_reboot'), callback_data="admin_reboot_confirm")],
+            [InlineKeyboardButton(self.t('btn_cancel'), callback_data="back_to_menu")]
+        ]))
+    
     async def get_channel_chat_id(self, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Get numeric chat ID for the configured channel"""
+        if self._resolved_channel_id is not None:
+            return self._resolved_channel_id
+        
         channel_id = self.config.CHANNEL_ID
         
         # If it's already a numeric ID, return it as int
@@ -57,96 +534,189 @@ class WorkingMTProxyBot:
         # If it's a username, resolve it to numeric ID
         try:
             chat = await context.bot.get_chat(channel_id)
+            self._resolved_channel_id = chat.id
             return chat.id
         except Exception as e:
-            logger.error(f"❌ Could not resolve channel ID '{channel_id}': {e}")
+            logger.error("❌ Could not resolve channel ID '%s': %s", channel_id, e)
             raise
     
+    def _is_target_channel(self, chat) -> bool:
+        """Check whether chat is the configured channel, without any API call"""
+        if self._resolved_channel_id is not None:
+            return chat.id == self._resolved_channel_id
+        
+        channel_id = self.config.CHANNEL_ID
+        if channel_id.startswith('-') and channel_id[1:].isdigit():
+            return chat.id == int(channel_id)
+        
+        # Username form: match it, and remember the numeric ID for next time
+        if chat.username and chat.username.lower() == self.config.CHANNEL_USERNAME.lower():
+            self._resolved_channel_id = chat.id
+            return True
+        return False
+    
+    def _cache_status(self, user_id: int, status, now=None):
+        """Store a user's channel member status in the LRU cache"""
+        self._membership_cache[user_id] = (now or time.time(), status)
+        self._membership_cache.move_to_end(user_id)
+        if len(self._membership_cache) > self.membership_cache_size:
+            self._membership_cache.popitem(last=False)
+    
+    async def _get_cached_status(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, ttl=None):
+        """Get user's channel member status, reusing a recent lookup if available"""
+        now = time.time()
+        hit = self._membership_cache.get(user_id)
+        if hit and now - hit[0] < (ttl or self.membership_cache_ttl):
+            self._membership_cache.move_to_end(user_id)
+            return hit[1]
+        
+        member = await context.bot.get_chat_member(self.config.CHANNEL_ID, user_id)
+        self._cache_status(user_id, member.status, now)
+        return member.status
+    
     async def is_channel_admin(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-        """Check if user is admin of the channel"""
+        """Check if user is admin of the channel (cached for admin_cache_ttl seconds)"""
         try:
-            member = await context.bot.get_chat_member(self.config.CHANNEL_ID, user_id)
-            return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
+            status = await self._get_cached_status(context, user_id, ttl=self.admin_cache_ttl)
+            return status in _ADMIN_STATUSES
         except Exception as e:
-            logger.error(f"Error checking admin status for user {user_id}: {e}")
+            logger.error("Error checking admin status for user %s: %s", user_id, e)
             return False
     
+    def _set_cached_secret(self, user_id: int, secret):
+        """Record a write of the user's active secret (None once deactivated)"""
+        self._secret_cache_epoch += 1  # Lookups already in flight must not cache what they read
+        if secret is None:
+            self._secret_cache.pop(user_id, None)
+            return
+        self._secret_cache[user_id] = secret
+        self._secret_cache.move_to_end(user_id)
+        if len(self._secret_cache) > self.secret_cache_size:
+            self._secret_cache.popitem(last=False)
+    
+    async def _get_active_secret(self, user_id: int):
+        """Get the user's active proxy secret (None if they have none), from the LRU cache when possible"""
+        secret = self._secret_cache.get(user_id)
+        if secret is not None:
+            self._secret_cache.move_to_end(user_id)
+            return secret
+        
+        epoch = self._secret_cache_epoch
+        user_data = await asyncio.to_thread(self.db.get_user, user_id)
+        if not (user_data and user_data['is_active']):
+            return None
+        if epoch == self._secret_cache_epoch:
+            self._secret_cache[user_id] = user_data['secret']
+            if len(self._secret_cache) > self.secret_cache_size:
+                self._secret_cache.popitem(last=False)
+        return user_data['secret']
+    
     def is_rate_limited(self, user_id: int) -> bool:
         """Check if user is rate limited"""
         now = time.time()
-        user_actions = self.user_rate_limit[user_id]
-        
-        # Remove old actions (older than 60 seconds)
-        while user_actions and now - user_actions[0] > 60:
-            user_actions.popleft()
+        ring = self.user_rate_limit[user_id]
         
-        # Check if user has too many recent actions
-        if len(user_actions) >= 5:  # Max 5 actions per minute
-            self.stats['rate_limited'] += 1
+        # The oldest of the last N actions sits in the slot we would overwrite next
+        idx = ring[-1] % self.rate_limit_actions
+        if now - ring[idx] < self.rate_limit_window:
+            self.stats.rate_limited += 1
             return True
         
-        # Add current action
-        user_actions.append(now)
+        # Record current action
+        ring[idx] = now
+        ring[-1] += 1
         return False
-        
+    
+    async def _gc_rate_limits(self, interval=300):
+        """Periodically drop rate limit entries for users idle longer than the window"""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            stale = [user_id for user_id, ring in self.user_rate_limit.items()
+                     if now - ring[(ring[-1] - 1) % self.rate_limit_actions] > self.rate_limit_window]
+            for user_id in stale:
+                del self.user_rate_limit[user_id]
+            if stale:
+                logger.debug("Dropped %s idle rate limit entries", len(stale))
+    
+    def _refill_secret_pool(self):
+        """Fill the secret pool from a single os.urandom read"""
+        raw = os.urandom(16 * self.secret_pool_size)
+        self._secret_pool.extend(raw[i:i + 16].hex() for i in range(0, len(raw), 16))
+    
     def generate_secret(self):
         """Generate 32-char hex secret"""
-        return secrets.token_hex(16)
+        if not self._secret_pool:
+            self._refill_secret_pool()
+        return self._secret_pool.popleft()
+    
+    def _parse_service_content(self, content):
+        """Parse MTProxy settings out of service file content (None if there is no ExecStart)"""
+        # Extract ExecStart line
+        _, found, rest = content.partition('ExecStart=')
+        exec_line = rest.split('\n', 1)[0]
+        if not found or not exec_line:
+            return None
+        
+        # Parse parameters (secrets is an insertion-ordered dict used as a set)
+        config = {
+            'secrets': {},
+            'port': '8888',
+            'tag': '',
+            'tls_domain': 'www.cloudflare.com',
+            'workers': '1'
+        }
+        
+        # Walk the ExecStart argv once, picking up each "-X value" pair
+        tokens = iter(exec_line.split())
+        for token in tokens:
+            if token == '-H':
+                config['port'] = next(tokens, config['port'])
+            elif token == '-S':
+                secret = next(tokens, None)
+                if secret and len(secret) == 32 and _HEX_DIGITS.issuperset(secret):
+                    config['secrets'][secret] = None
+            elif token == '-P':
+                config['tag'] = next(tokens, config['tag'])
+            elif token == '-D':
+                config['tls_domain'] = next(tokens, config['tls_domain'])
+            elif token == '-M':
+                config['workers'] = next(tokens, config['workers'])
+        
+        return config
     
-    def _parse_service_file(self):
-        """Parse the current MTProxy service file"""
+    def _parse_service_file(self, copy=True):
+        """Parse the current MTProxy service file
+        
+        With copy=False the shared cached config is returned and must not be modified.
+        """
         try:
-            with open(self.service_file, 'r') as f:
-                content = f.read()
-            
-            # Extract ExecStart line
-            exec_match = re.search(r'ExecStart=(.+)', content)
-            if not exec_match:
-                return None
+            # Reuse the last parse while the file is unchanged on disk
+            st = os.stat(self.service_file)
+            stat_key = (st.st_mtime_ns, st.st_size)
+            if self._service_cache and self._service_cache[0] == stat_key:
+                config = self._service_cache[1]
+            else:
+                with open(self.service_file, 'r') as f:
+                    content = f.read()
                 
-            exec_line = exec_match.group(1)
-            
-            # Parse parameters
-            config = {
-                'secrets': [],
-                'port': '8888',
-                'tag': '',
-                'tls_domain': 'www.cloudflare.com',
-                'workers': '1'
-            }
-            
-            # Extract port
-            port_match = re.search(r'-H (\d+)', exec_line)
-            if port_match:
-                config['port'] = port_match.group(1)
-            
-            # Extract secrets
-            secret_matches = re.findall(r'-S ([a-f0-9]{32})', exec_line)
-            config['secrets'] = secret_matches
-            
-            # Extract tag
-            tag_match = re.search(r'-P ([a-f0-9]{32})', exec_line)
-            if tag_match:
-                config['tag'] = tag_match.group(1)
-            
-            # Extract TLS domain
-            domain_match = re.search(r'-D ([^\s]+)', exec_line)
-            if domain_match:
-                config['tls_domain'] = domain_match.group(1)
-            
-            # Extract workers
-            worker_match = re.search(r'-M (\d+)', exec_line)
-            if worker_match:
-                config['workers'] = worker_match.group(1)
-            
-            return config
+                config = self._parse_service_content(content)
+                if config is None:
+                    return None
+                self._service_cache = (stat_key, config)
+            
+            return dict(config, secrets=dict(config['secrets'])) if copy else config
             
         except Exception as e:
-            logger.error(f"Error parsing service file: {e}")
+            logger.error("Error parsing service file: %s", e)
             return None
     
     def _write_service_file(self, config):
-        """Write updated service file"""
+        """Write updated service file atomically
+        
+        Returns 'changed' if the file was rewritten, 'unchanged' if it already
+        had the same content, or False on error.
+        """
         try:
             # Build ExecStart command
             secrets_str = ' '.join([f'-S {s}' for s in config['secrets']])
@@ -171,56 +741,126 @@ StartLimitBurst=0
 [Install]
 WantedBy=multi-user.target"""
             
-            with open(self.service_file, 'w') as f:
+            # Skip the write (and the daemon-reload) if nothing changed
+            try:
+                with open(self.service_file, 'r') as f:
+                    if f.read() == service_content:
+                        return 'unchanged'
+                    old_stat = os.fstat(f.fileno())
+            except FileNotFoundError:
+                old_stat = None
+            
+            # Write to a temp file and rename so systemd never sees a partial unit
+            self._service_cache = None
+            tmp_file = f"{self.service_file}.tmp"
+            with open(tmp_file, 'w') as f:
                 f.write(service_content)
+                f.flush()
+                # Keep the unit's existing mode and owner across the rename
+                if old_stat is not None:
+                    os.fchmod(f.fileno(), old_stat.st_mode & 0o7777)
+                    os.fchown(f.fileno(), old_stat.st_uid, old_stat.st_gid)
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.service_file)
             
-            return True
+            # Prime the parse cache from what we just wrote, so the next read skips the disk
+            st = os.stat(self.service_file)
+            self._service_cache = ((st.st_mtime_ns, st.st_size), self._parse_service_content(service_content))
+            
+            return 'changed'
             
         except Exception as e:
-            logger.error(f"Error writing service file: {e}")
+            logger.error("Error writing service file: %s", e)
             return False
     
+    @staticmethod
+    async def _read_capped(stream, limit):
+        """Read up to limit bytes from stream, then drain and discard the rest"""
+        data = bytearray()
+        while len(data) < limit:
+            chunk = await stream.read(limit - len(data))
+            if not chunk:
+                return bytes(data)
+            data += chunk
+        while await stream.read(65536):
+            pass
+        return bytes(data)
+    
+    async def _run_command(self, *args, timeout=None, check=False, output_limit=4096,
+                           capture_stdout=True, capture_stderr=True):
+        """Run a command without blocking the event loop (subprocess.run semantics, output capped).
+        Streams that aren't captured go to /dev/null and come back as empty strings."""
+        pipe, devnull = asyncio.subprocess.PIPE, asyncio.subprocess.DEVNULL
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=pipe if capture_stdout else devnull, stderr=pipe if capture_stderr else devnull
+        )
+        try:
+            stdout, stderr, _ = await asyncio.wait_for(asyncio.gather(
+                self._read_capped(proc.stdout, output_limit) if capture_stdout else asyncio.sleep(0, b''),
+                self._read_capped(proc.stderr, output_limit) if capture_stderr else asyncio.sleep(0, b''),
+                proc.wait()
+            ), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.TimeoutExpired(list(args), timeout)
+        
+        result = subprocess.CompletedProcess(list(args), proc.returncode,
+                                             stdout.decode(errors='replace'), stderr.decode(errors='replace'))
+        if check:
+            result.check_returncode()
+        return result
+    
+    async def _spawn_reboot(self, delay=1):
+        """Start a detached `systemctl reboot` after delay seconds, without waiting on it"""
+        # Own session so the reboot survives systemd stopping this bot; the delay
+        # lets pending Telegram requests go out before we are killed
+        await asyncio.create_subprocess_exec(
+            'sh', '-c', f'sleep {delay} && systemctl reboot',
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True
+        )
+    
     async def _wait_for_service_status(self, expected_status, max_attempts=15, delay=0.5):
         """Wait for service to reach expected status with polling"""
         for attempt in range(max_attempts):
             try:
-                result = subprocess.run(['systemctl', 'is-active', 'MTProxy'], 
-                                      capture_output=True, text=True, timeout=5)
+                result = await self._run_command('systemctl', 'is-active', 'MTProxy', timeout=5, capture_stderr=False)
                 current_status = result.stdout.strip()
                 
                 if current_status == expected_status:
-                    logger.info(f"Service reached {expected_status} status after {attempt + 1} attempts")
+                    logger.info("Service reached %s status after %s attempts", expected_status, attempt + 1)
                     return True
                     
-                logger.debug(f"Attempt {attempt + 1}: Service status is '{current_status}', waiting for '{expected_status}'")
+                logger.debug("Attempt %s: Service status is '%s', waiting for '%s'", attempt + 1, current_status, expected_status)
                 await asyncio.sleep(delay)
                 
             except Exception as e:
-                logger.warning(f"Error checking service status on attempt {attempt + 1}: {e}")
+                logger.warning("Error checking service status on attempt %s: %s", attempt + 1, e)
                 await asyncio.sleep(delay)
         
-        logger.error(f"Service failed to reach {expected_status} status after {max_attempts} attempts")
+        logger.error("Service failed to reach %s status after %s attempts", expected_status, max_attempts)
         return False
     
-    async def _restart_mtproxy_service(self):
+    def _set_pid_max(self, value):
+        """Write kernel.pid_max directly instead of spawning an echo process"""
+        with open('/proc/sys/kernel/pid_max', 'w') as f:
+            f.write(f"{value}\n")
+    
+    async def _restart_mtproxy_service(self, reload=True):
         """Restart MTProxy service with pid_max workaround for MTProxy bug"""
         try:
-            # Stop service
-            logger.info("Stopping MTProxy service...")
-            subprocess.run(['systemctl', 'stop', 'MTProxy'], check=False)
-            
-            # Wait for service to actually stop
-            if not await self._wait_for_service_status('inactive'):
-                logger.warning("Service didn't stop cleanly, proceeding anyway")
-            
             # Set pid_max to 32768 before starting MTProxy (workaround for MTProxy bug)
-            subprocess.run(['echo', '32768'], stdout=open('/proc/sys/kernel/pid_max', 'w'), check=True)
+            self._set_pid_max(32768)
             logger.info("Set pid_max to 32768 before MTProxy start")
             
-            # Reload and start
-            logger.info("Starting MTProxy service...")
-            subprocess.run(['systemctl', 'daemon-reload'], check=True)
-            subprocess.run(['systemctl', 'start', 'MTProxy'], check=True)
+            # Reload unit files and restart (stop + start in one systemd job)
+            logger.info("Restarting MTProxy service...")
+            if reload:
+                await self._run_command('systemctl', 'daemon-reload', check=True, capture_stdout=False)
+            await self._run_command('systemctl', 'restart', 'MTProxy', check=True, capture_stdout=False)
             
             # Wait for service to actually start and become active
             if not await self._wait_for_service_status('active'):
@@ -228,7 +868,7 @@ WantedBy=multi-user.target"""
                 return False
             
             # Restore pid_max to default value (4194304)
-            subprocess.run(['echo', '4194304'], stdout=open('/proc/sys/kernel/pid_max', 'w'), check=True)
+            self._set_pid_max(4194304)
             logger.info("Restored pid_max to default value 4194304")
             
             # Update restart timestamp
@@ -237,101 +877,158 @@ WantedBy=multi-user.target"""
             return True
             
         except Exception as e:
-            logger.error(f"❌ Error restarting MTProxy: {e}")
+            logger.error("❌ Error restarting MTProxy: %s", e)
             # Try to restore pid_max even if restart failed
             try:
-                subprocess.run(['echo', '4194304'], stdout=open('/proc/sys/kernel/pid_max', 'w'), check=True)
+                self._set_pid_max(4194304)
                 logger.info("Restored pid_max to default after error")
             except:
                 logger.error("Failed to restore pid_max after error")
             return False
     
     async def add_secret(self, secret):
-        """Add secret to MTProxy with rate limiting and error handling"""
+        """Add secret to MTProxy (batched with other pending changes)"""
+        return await self._submit_mtproxy_op('add', secret)
+    
+    async def remove_secret(self, secret):
+        """Remove secret from MTProxy (batched with other pending changes)"""
+        return await self._submit_mtproxy_op('remove', secret)
+    
+    async def _submit_mtproxy_op(self, op, secret):
+        """Queue a secret change and wait for the batch that applies it"""
         try:
-            async with self.operation_lock:
-                # Check if we need to wait for cooldown
-                now = time.time()
-                if now - self.last_mtproxy_restart < self.restart_cooldown:
-                    wait_time = self.restart_cooldown - (now - self.last_mtproxy_restart)
-                    logger.info(f"Waiting {wait_time:.1f}s for MTProxy cooldown")
-                    await asyncio.sleep(wait_time)
-                
-                config = self._parse_service_file()
-                if not config:
-                    logger.error("Failed to parse service file")
-                    self.stats['errors'] += 1
-                    return False
-                
-                # Add secret if not already present
-                if secret not in config['secrets']:
-                    config['secrets'].append(secret)
-                    
-                    # Write new service file
-                    if not self._write_service_file(config):
-                        self.stats['errors'] += 1
-                        return False
-                    
-                    # Restart MTProxy with pid_max workaround
-                    if not await self._restart_mtproxy_service():
-                        self.stats['errors'] += 1
-                        return False
-                    self.stats['proxies_created'] += 1
-                    logger.info(f"✅ Added secret: {secret[:8]}...")
-                    return True
-                else:
-                    logger.info(f"✅ Secret already exists: {secret[:8]}...")
-                    return True
-                    
+            # Start the drainer on first use (or if it died)
+            if self._mtproxy_drainer is None or self._mtproxy_drainer.done():
+                self._mtproxy_drainer = asyncio.create_task(self._drain_mtproxy_ops())
+            
+            future = asyncio.get_running_loop().create_future()
+            await self.mtproxy_operations.put((op, secret, future))
+            return await future
         except Exception as e:
-            logger.error(f"❌ Error adding secret: {e}")
-            self.stats['errors'] += 1
+            logger.error("❌ Error queueing %s for secret %s...: %s", op, secret[:8], e)
+            self.stats.errors += 1
             return False
     
-    async def remove_secret(self, secret):
-        """Remove secret from MTProxy with rate limiting"""
-        try:
-            async with self.operation_lock:
-                # Check if we need to wait for cooldown
-                now = time.time()
-                if now - self.last_mtproxy_restart < self.restart_cooldown:
-                    wait_time = self.restart_cooldown - (now - self.last_mtproxy_restart)
-                    logger.info(f"Waiting {wait_time:.1f}s for MTProxy cooldown")
-                    await asyncio.sleep(wait_time)
-                
-                config = self._parse_service_file()
-                if not config:
-                    self.stats['errors'] += 1
-                    return False
-                
-                if secret in config['secrets']:
-                    config['secrets'].remove(secret)
-                    
-                    # Write new service file
-                    if not self._write_service_file(config):
-                        self.stats['errors'] += 1
-                        return False
-                    
-                    # Restart MTProxy with pid_max workaround
-                    if not await self._restart_mtproxy_service():
-                        self.stats['errors'] += 1
-                        return False
-                    self.stats['proxies_removed'] += 1
-                    logger.info(f"✅ Removed secret: {secret[:8]}...")
-                    return True
+    async def _drain_mtproxy_ops(self):
+        """Apply queued secret changes with one service file write and restart per batch"""
+        while True:
+            batch = [await self.mtproxy_operations.get()]
+            
+            # Check if we need to wait for cooldown
+            now = time.time()
+            if now - self.last_mtproxy_restart < self.restart_cooldown:
+                wait_time = self.restart_cooldown - (now - self.last_mtproxy_restart)
+                logger.info("Waiting %.1fs for MTProxy cooldown", wait_time)
+                await asyncio.sleep(wait_time)
+            
+            # Everything queued during the cooldown joins this batch
+            while True:
+                try:
+                    batch.append(self.mtproxy_operations.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            
+            try:
+                success = await self._apply_mtproxy_ops(batch)
+            except Exception as e:
+                logger.error("❌ Error applying MTProxy changes: %s", e)
+                success = False
+            
+            if not success:
+                self.stats.errors += len(batch)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(success)
+    
+    async def _apply_mtproxy_ops(self, batch):
+        """Apply a batch of (op, secret, future) changes to the service file"""
+        config = self._parse_service_file()
+        if not config:
+            logger.error("Failed to parse service file")
+            return False
+        
+        added = []
+        removed = []
+        for op, secret, _ in batch:
+            if op == 'add':
+                if secret not in config['secrets']:
+                    config['secrets'][secret] = None
+                    added.append(secret)
                 else:
-                    logger.info(f"✅ Secret not found: {secret[:8]}...")
-                    return True
-                    
+                    logger.info("✅ Secret already exists: %s...", secret[:8])
+            elif secret in config['secrets']:
+                del config['secrets'][secret]
+                removed.append(secret)
+            else:
+                logger.info("✅ Secret not found: %s...", secret[:8])
+        
+        if not added and not removed:
+            return True
+        
+        # Only the file write and restart are serialized with admin restarts
+        async with self.operation_lock:
+            # Write new service file (the fsync runs off the event loop)
+            write_result = await asyncio.to_thread(self._write_service_file, config)
+            if not write_result:
+                return False
+            
+            # Restart MTProxy with pid_max workaround
+            if not await self._restart_mtproxy_service(reload=write_result == 'changed'):
+                return False
+        
+        self.stats.proxies_created += len(added)
+        self.stats.proxies_removed += len(removed)
+        for secret in added:
+            logger.info("✅ Added secret: %s...", secret[:8])
+        for secret in removed:
+            logger.info("✅ Removed secret: %s...", secret[:8])
+        if len(batch) > 1:
+            logger.info("Applied %s queued MTProxy changes with one restart", len(batch))
+        return True
+    
+    async def _fetch_public_ip(self):
+        """Look up public IP of this server"""
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.get('https://api.ipify.org')
+            response.raise_for_status()
+            return response.text.strip()
+    
+    async def _get_public_ip(self):
+        """Get public IP of this server, cached for public_ip_ttl seconds"""
+        now = time.time()
+        if self._public_ip and now - self._public_ip_fetched_at < self.public_ip_ttl:
+            return self._public_ip
+        
+        # Don't make every link wait out the timeout again right after a failed lookup
+        if now - self._public_ip_failed_at < self.public_ip_retry_delay:
+            return self._public_ip or "130.185.123.84"
+        
+        # One lookup at a time; concurrent callers share it (shielded, so one caller's
+        # cancellation doesn't cancel it for the rest)
+        if self._public_ip_lookup is None:
+            self._public_ip_lookup = asyncio.ensure_future(self._refresh_public_ip())
+        return await asyncio.shield(self._public_ip_lookup)
+    
+    async def _refresh_public_ip(self):
+        """Fetch and cache the public IP, falling back to the last known IP, then to the default server"""
+        try:
+            public_ip = await self._fetch_public_ip()
+            if not public_ip:
+                raise ValueError("empty response")
+            self._public_ip = public_ip
+            self._public_ip_fetched_at = time.time()
         except Exception as e:
-            logger.error(f"❌ Error removing secret: {e}")
-            self.stats['errors'] += 1
-            return False
+            logger.warning("Could not fetch public IP: %s", e)
+            self._public_ip_failed_at = time.time()
+        finally:
+            self._public_ip_lookup = None
+        return self._public_ip or "130.185.123.84"
     
-    def get_proxy_link(self, secret):
+    async def get_proxy_link(self, secret):
         """Generate proxy link"""
         try:
-            config = self._parse_service_file()
+            # Only port and domain are needed: read the cached config in place, no secrets copy
+            config = self._parse_service_file(copy=False)
             if not config:
                 # Fallback values
                 port = "8888"
@@ -340,17 +1037,11 @@ WantedBy=multi-user.target"""
                 port = config['port']
                 tls_domain = config['tls_domain']
             
-            # Get public IP
-            try:
-                result = subprocess.run(['curl', 'https://api.ipify.org', '-sS'], 
-                                      capture_output=True, text=True, timeout=10)
-                public_ip = result.stdout.strip() if result.returncode == 0 else "130.185.123.84"
-            except:
-                public_ip = "130.185.123.84"
+            public_ip = await self._get_public_ip()
             
             # Generate link exactly like your working example
-            if tls_domain and tls_domain != '""':
-                hex_domain = tls_domain.encode('utf-8').hex().lower()
+            hex_domain = _tls_domain_hex(tls_domain)
+            if hex_domain:
                 full_secret = f"ee{secret}{hex_domain}"
             else:
                 full_secret = f"dd{secret}"
@@ -358,21 +1049,55 @@ WantedBy=multi-user.target"""
             return f"https://t.me/proxy?server={public_ip}&port={port}&secret={full_secret}"
             
         except Exception as e:
-            logger.error(f"Error generating link: {e}")
+            logger.error("Error generating link: %s", e)
             return f"https://t.me/proxy?server=130.185.123.84&port=8888&secret=ee{secret}77772e636c6f7564666c6172652e636f6d"
     
+    @contextlib.asynccontextmanager
+    async def _locked_user(self, user_id: int):
+        """Hold the user's lock, so their proxy is created/removed by one request at a time"""
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+    
+    async def _ensure_proxy(self, user_id: int, username: str):
+        """Give the user an active proxy unless they already have one.
+        Returns (created, error_key); error_key is None on success."""
+        async with self._locked_user(user_id):
+            # Checked under the lock, so racing requests can't each add a secret
+            existing_user = await asyncio.to_thread(self.db.get_user, user_id)
+            if existing_user and existing_user['is_active']:
+                return False, None
+            
+            secret = self.generate_secret()
+            if not await self.add_secret(secret):
+                return False, 'error_creating'
+            if not await asyncio.to_thread(self.db.add_user, user_id, username, secret):
+                # Don't leave a working secret behind that nothing tracks
+                await self.remove_secret(secret)
+                return False, 'error_saving'
+            self._set_cached_secret(user_id, secret)
+            return True, None
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user = update.effective_user
         
         try:
-            member = await context.bot.get_chat_member(self.config.CHANNEL_ID, user.id)
-            if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            status = await self._get_cached_status(context, user.id)
+            if status in _PRESENT_STATUSES:
                 await self._provide_proxy(update, context, user)
             else:
                 await self._request_join(update, context)
         except Exception as e:
-            logger.error(f"Error checking membership: {e}")
+            logger.error("Error checking membership: %s", e)
             await update.message.reply_text(self.t('error_membership'))
     
     async def _provide_proxy(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user):
@@ -382,61 +1107,33 @@ WantedBy=multi-user.target"""
             await update.message.reply_text("⚠️ Please wait before requesting another proxy.")
             return
             
-        existing_user = self.db.get_user(user.id)
+        created, error_key = await self._ensure_proxy(user.id, user.username or f"user_{user.id}")
+        if error_key:
+            await update.message.reply_text(self.t(error_key))
+            return
         
-        if existing_user and existing_user['is_active']:
-            # Create button that requires confirmation
-            keyboard = [[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user.id}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                f"{self.t('welcome_back')}\n\n"
-                f"{self.t('how_to_connect')}\n"
-                f"{self.t('step_tap_button')}\n"
-                f"{self.t('step_telegram_ask')}\n"
-                f"{self.t('step_connect')}\n\n"
-                f"{self.t('stay_in_channel')}\n"
-                f"{self.t('security_notice')}",
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        else:
-            secret = self.generate_secret()
-            
-            if await self.add_secret(secret):
-                username = user.username or f"user_{user.id}"
-                if self.db.add_user(user.id, username, secret):
-                    # Create button that requires confirmation
-                    keyboard = [[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user.id}")]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await update.message.reply_text(
-                        f"{self.t('welcome_new')}\n\n"
-                        f"{self.t('how_to_connect')}\n"
-                        f"{self.t('step_tap_button')}\n"
-                        f"{self.t('step_telegram_ask')}\n"
-                        f"{self.t('step_connect')}\n\n"
-                        f"{self.t('stay_in_channel')}\n"
-                        f"{self.t('security_notice')}",
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await update.message.reply_text(self.t('error_saving'))
-            else:
-                await update.message.reply_text(self.t('error_creating'))
+        # Create button that requires confirmation
+        reply_markup = self._get_proxy_keyboard(user.id)
+        
+        await update.message.reply_text(
+            self._welcome_new_text if created else self._welcome_back_text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
     
     async def handle_proxy_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle proxy button callback"""
         query = update.callback_query
-        await query.answer()
+        if self._is_duplicate_callback(query.id):
+            return
+        context.application.create_task(query.answer(), update=update)
         
-        # Extract user ID from callback data
-        callback_data = query.data
-        if not callback_data.startswith("get_proxy_"):
+        # Extract user ID from callback data ("get_proxy_<user_id>")
+        prefix, _, user_id_str = query.data.rpartition('_')
+        if prefix != 'get_proxy' or not user_id_str.isdigit():
             return
             
-        requested_user_id = int(callback_data.split("_")[2])
+        requested_user_id = int(user_id_str)
         actual_user_id = query.from_user.id
         
         # Security check: only the user can get their own proxy
@@ -445,34 +1142,25 @@ WantedBy=multi-user.target"""
             return
         
         # Get user's proxy
-        user_data = self.db.get_user(actual_user_id)
-        if user_data and user_data['is_active']:
-            proxy_link = self.get_proxy_link(user_data['secret'])
+        secret = await self._get_active_secret(actual_user_id)
+        if secret:
+            proxy_link = await self.get_proxy_link(secret)
             
             # Create button with actual proxy link
-            keyboard = [[InlineKeyboardButton(self.t('btn_connect_proxy'), url=proxy_link)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = self._connect_proxy_keyboard(proxy_link)
             
             await query.edit_message_text(
-                f"{self.t('personal_proxy')}\n\n"
-                f"{self.t('tap_to_connect')}\n\n"
-                f"{self.t('security_notice_title')}\n"
-                f"{self.t('security_personal')}\n"
-                f"{self.t('security_no_share')}\n"
-                f"{self.t('security_stay_active')}",
+                self._personal_proxy_text,
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
     
     async def _request_join(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Request user to join channel"""
-        keyboard = [[InlineKeyboardButton(self.t('btn_join_channel'), url=f"https://t.me/{self.config.CHANNEL_USERNAME}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._join_channel_keyboard(False)
         
         await update.message.reply_text(
-            f"{self.t('access_required')}\n\n"
-            f"{self.t('join_first')}\n\n"
-            f"👆 {self.t('auto_receive')}",
+            self._join_request_text,
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
@@ -480,347 +1168,257 @@ WantedBy=multi-user.target"""
     async def handle_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle channel member updates with rate limiting and error handling"""
         try:
-            # Check if this update is for our channel
-            chat_id = update.chat_member.chat.id
-            
-            # Get our target channel's numeric ID
-            try:
-                target_chat_id = await self.get_channel_chat_id(context)
-            except Exception as e:
-                logger.error(f"❌ Could not resolve target channel ID: {e}")
-                return
-            
-            # Only process updates for our target channel
-            if chat_id != target_chat_id:
-                return
-                
+            # Updates from other chats are dropped by _ChannelMemberHandler before we get here
             user_id = update.chat_member.new_chat_member.user.id
             username = update.chat_member.new_chat_member.user.username or "no_username"
             old_status = update.chat_member.old_chat_member.status
             new_status = update.chat_member.new_chat_member.status
             
+            # We already have the fresh status, keep the membership cache in sync
+            self._cache_status(user_id, new_status)
+            
             # Rate limiting check
             if self.is_rate_limited(user_id):
-                logger.warning(f"⚠️ Rate limited user {user_id}, skipping action")
+                logger.warning("⚠️ Rate limited user %s, skipping action", user_id)
                 return
             
-            logger.info(f"👤 Member update for user {user_id} (@{username}): {old_status} -> {new_status}")
+            logger.debug("👤 Member update for user %s (@%s): %s -> %s", user_id, username, old_status, new_status)
             
             # User joined the channel
             if (old_status == ChatMemberStatus.LEFT and 
-                new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]):
+                new_status in _PRESENT_STATUSES):
                 
-                self.stats['joins'] += 1
-                logger.info(f"🎉 User {user_id} joined the channel! (Total joins: {self.stats['joins']})")
+                self.stats.joins += 1
+                logger.info("🎉 User %s joined the channel! (Total joins: %s)", user_id, self.stats.joins)
                 
                 # Automatically provide proxy to new member
                 await self._auto_provide_proxy(context, user_id, username)
             
             # User left the channel
-            elif (old_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER] and 
+            elif (old_status in _PRESENT_STATUSES and 
                   new_status == ChatMemberStatus.LEFT):
                 
-                self.stats['leaves'] += 1
-                logger.info(f"🚪 User {user_id} left the channel! (Total leaves: {self.stats['leaves']})")
+                self.stats.leaves += 1
+                logger.info("🚪 User %s left the channel! (Total leaves: %s)", user_id, self.stats.leaves)
                 
-                user_data = self.db.get_user(user_id)
-                if user_data and user_data['is_active']:
-                    logger.info(f"🔑 Found active proxy for user {user_id}, secret: {user_data['secret'][:8]}...")
-                    logger.info(f"🗑️ Removing proxy access for user {user_id}")
-                    
-                    if await self.remove_secret(user_data['secret']):
-                        self.db.deactivate_user(user_id)
-                        logger.info(f"✅ Successfully deactivated proxy for user {user_id}")
+                # Under the user's lock, so a quick join/leave pair is applied in order
+                async with self._locked_user(user_id):
+                    user_data = await asyncio.to_thread(self.db.get_user, user_id)
+                    if user_data and user_data['is_active']:
+                        logger.debug("🔑 Found active proxy for user %s, secret: %s...", user_id, user_data['secret'][:8])
+                        logger.debug("🗑️ Removing proxy access for user %s", user_id)
+                        
+                        if await self.remove_secret(user_data['secret']):
+                            await asyncio.to_thread(self.db.deactivate_user, user_id)
+                            self._set_cached_secret(user_id, None)
+                            logger.info("✅ Successfully deactivated proxy for user %s", user_id)
                         
-                        # Try to notify user (optional) - but don't block on it
-                        asyncio.create_task(self._notify_user_deactivation(context, user_id))
+                            # Try to notify user (optional) - but don't block on it
+                            asyncio.create_task(self._notify_user_deactivation(context, user_id))
+                        else:
+                            logger.error("❌ Failed to remove secret for user %s", user_id)
                     else:
-                        logger.error(f"❌ Failed to remove secret for user {user_id}")
-                else:
-                    logger.info(f"ℹ️ User {user_id} left but had no active proxy")
+                        logger.info("ℹ️ User %s left but had no active proxy", user_id)
             else:
-                logger.info(f"ℹ️ Status change not relevant: {old_status} -> {new_status}")
+                logger.debug("ℹ️ Status change not relevant: %s -> %s", old_status, new_status)
                 
         except Exception as e:
-            logger.error(f"❌ Error in handle_member_update: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Error in handle_member_update: %s", e)
     
     async def _notify_user_deactivation(self, context: ContextTypes.DEFAULT_TYPE, user_id: int):
         """Notify user about proxy deactivation (non-blocking)"""
         try:
             await context.bot.send_message(user_id, self.t('proxy_deactivated'))
-            logger.info(f"📨 Notified user {user_id} about deactivation")
+            logger.info("📨 Notified user %s about deactivation", user_id)
         except Exception as e:
-            logger.info(f"📨 Could not notify user {user_id}: {e}")
+            logger.info("📨 Could not notify user %s: %s", user_id, e)
     
     async def _auto_provide_proxy(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, username: str):
         """Automatically provide proxy to new channel member"""
         try:
-            # Check if user already has an active proxy
-            existing_user = self.db.get_user(user_id)
+            # Reuses the active proxy if the user already has one
+            created, error_key = await self._ensure_proxy(user_id, username or f"user_{user_id}")
+            if error_key == 'error_saving':
+                logger.error("Failed to save user %s to database", user_id)
+                return
+            if error_key:
+                logger.error("Failed to add secret for user %s", user_id)
+                return
             
-            if existing_user and existing_user['is_active']:
-                logger.info(f"User {user_id} rejoined - reactivating existing proxy")
-                # User rejoined, just send them their existing proxy
-                keyboard = [[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user_id}")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await context.bot.send_message(
-                    user_id,
-                    f"{self.t('welcome_auto_back')}\n\n"
-                    f"{self.t('how_to_connect')}\n"
-                    f"{self.t('step_tap_button')}\n"
-                    f"{self.t('step_telegram_ask')}\n"
-                    f"{self.t('step_connect')}\n\n"
-                    f"{self.t('security_notice')}",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            else:
-                logger.info(f"Creating new proxy for user {user_id}")
-                # Create new proxy for new user
-                secret = self.generate_secret()
-                
-                if await self.add_secret(secret):
-                    user_name = username or f"user_{user_id}"
-                    if self.db.add_user(user_id, user_name, secret):
-                        keyboard = [[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user_id}")]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        
-                        await context.bot.send_message(
-                            user_id,
-                            f"{self.t('welcome_auto_new')}\n\n"
-                            f"{self.t('how_to_connect')}\n"
-                            f"{self.t('step_tap_button')}\n"
-                            f"{self.t('step_telegram_ask')}\n"
-                            f"{self.t('step_connect')}\n\n"
-                            f"{self.t('stay_in_channel')}\n"
-                            f"{self.t('security_notice')}",
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                        logger.info(f"✅ Sent auto-proxy to user {user_id}")
-                    else:
-                        logger.error(f"Failed to save user {user_id} to database")
-                else:
-                    logger.error(f"Failed to add secret for user {user_id}")
-                    
-        except Exception as e:
-            logger.error(f"Error auto-providing proxy to user {user_id}: {e}")
+            if not created:
+                logger.info("User %s rejoined - reactivating existing proxy", user_id)
+            reply_markup = self._get_proxy_keyboard(user_id)
+            
+            await context.bot.send_message(
+                user_id,
+                self._welcome_auto_new_text if created else self._welcome_auto_back_text,
+                reply_markup=reply_markup,
+                parse_mode='Markdown'
+            )
+            if created:
+                logger.info("✅ Sent auto-proxy to user %s", user_id)
                 
         except Exception as e:
-            logger.error(f"❌ Error in handle_member_update: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.error("Error auto-providing proxy to user %s: %s", user_id, e)
     
     async def menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show main menu"""
         user = update.effective_user
         
-        # Check if user is in channel
+        # Check if user is in channel while loading their record
         try:
-            member = await context.bot.get_chat_member(self.config.CHANNEL_ID, user.id)
-            if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-                # User is in channel - show proxy options
-                user_data = self.db.get_user(user.id)
-                
-                if user_data and user_data['is_active']:
-                    keyboard = [
-                        [InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user.id}")],
-                        [InlineKeyboardButton(self.t('btn_proxy_status'), callback_data=f"status_{user.id}")],
-                        [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
-                    ]
-                else:
-                    keyboard = [
-                        [InlineKeyboardButton(self.t('btn_create_proxy'), callback_data=f"create_proxy_{user.id}")],
-                        [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
-                    ]
-                
-                # Add admin controls for channel admins
-                if await self.is_channel_admin(context, user.id):
-                    keyboard.append([InlineKeyboardButton("📌 پین منوی کانال", callback_data="admin_pin_menu")])
-                    keyboard.append([InlineKeyboardButton("🗑️ حذف همه پین‌ها", callback_data="admin_unpin_all")])
-                    keyboard.append([InlineKeyboardButton("📊 آمار ربات", callback_data="admin_stats")])
-                    keyboard.append([InlineKeyboardButton("🔄 راه‌اندازی مجدد پروکسی", callback_data="admin_restart_proxy")])
-                    keyboard.append([InlineKeyboardButton("🚨 راه‌اندازی مجدد سرور", callback_data="admin_reboot_vps")])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            status, user_data = await asyncio.gather(
+                self._get_cached_status(context, user.id),
+                asyncio.to_thread(self.db.get_user, user.id)
+            )
+            if status in _PRESENT_STATUSES:
+                # User is in channel - show proxy options, plus admin controls for
+                # channel admins (status is fresh, no extra lookup)
+                reply_markup = self._main_menu_keyboard(
+                    user.id, bool(user_data and user_data['is_active']), status in _ADMIN_STATUSES
+                )
                 await update.message.reply_text(
                     f"{self.t('menu_title')}\n\n"
-                    f"{self.t('menu_welcome', name=user.first_name)}",
+                    f"{self.t('menu_welcome', name=escape_markdown(user.first_name))}",
                     reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
             else:
                 # User not in channel
-                keyboard = [
-                    [InlineKeyboardButton(self.t('btn_join_channel'), url=f"https://t.me/{self.config.CHANNEL_USERNAME}")],
-                    [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = self._join_channel_keyboard(True)
                 
                 await update.message.reply_text(
-                    f"{self.t('access_required')}\n\n"
-                    f"{self.t('join_first')}\n\n"
-                    f"{self.t('auto_receive')}",
+                    self._access_required_text,
                     reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
         except Exception as e:
-            logger.error(f"Error in menu: {e}")
+            logger.error("Error in menu: %s", e)
             await update.message.reply_text(self.t('error_membership'))
     
     async def handle_menu_callbacks(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle menu button callbacks"""
         query = update.callback_query
-        await query.answer()
-        
         callback_data = query.data
-        user_id = query.from_user.id
+        if self._is_duplicate_callback(query.id):
+            return
         
-        if callback_data.startswith("status_"):
-            # Show proxy status
-            user_data = self.db.get_user(user_id)
-            if user_data and user_data['is_active']:
-                keyboard = [
-                    [InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user_id}")],
-                    [InlineKeyboardButton(self.t('btn_back_menu'), callback_data="back_to_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    f"{self.t('proxy_status_title')}\n\n"
-                    f"{self.t('status_active')}\n"
-                    f"{self.t('created_date', date=user_data['created_at'])}\n"
-                    f"{self.t('username_label', username=user_data['username'])}\n\n"
-                    f"{self.t('tip_stay_active')}",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            else:
-                await query.edit_message_text(self.t('no_active_proxy'))
+        # Check admin rights before taking an operation's lock, so non-admins can't hold it
+        route = self._callback_routes.get(callback_data)
+        if route is not None and route[1] and not await self.is_channel_admin(context, query.from_user.id):
+            context.application.create_task(query.answer(), update=update)
+            await query.edit_message_text(self.t('access_denied'))
+            return
         
-        elif callback_data.startswith("create_proxy_"):
-            # Create new proxy
-            await self._provide_proxy_via_callback(query, context)
+        # Single-flight admin operations: refuse a second run while one is in progress
+        op_lock = self._admin_op_locks.get(callback_data)
+        if op_lock is not None:
+            if op_lock.locked():
+                await query.answer(self.t('admin_busy'), show_alert=True)
+                return
+            await op_lock.acquire()  # Uncontended, so this does not yield
         
-        elif callback_data == "help":
-            # Show help
-            keyboard = [[InlineKeyboardButton(self.t('btn_back_menu'), callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        try:
+            # Acknowledge right away without waiting on the round-trip, so the button
+            # spinner stops even while slow admin work runs below
+            ack_text = self._callback_ack_keys.get(callback_data)
+            context.application.create_task(
+                query.answer(text=self.t(ack_text) if ack_text else None), update=update
+            )
+            
+            if route:
+                handler = route[0]
+                if callback_data == 'admin_reboot_confirm':
+                    # Same cancellable countdown task as /reboot_vps, which shares this lock
+                    self._reboot_task = asyncio.create_task(self._release_after(handler(query, context), op_lock))
+                    op_lock = None  # Released by the countdown task
+                elif callback_data in self._background_callbacks:
+                    context.application.create_task(self._release_after(handler(query, context), op_lock), update=update)
+                    op_lock = None  # Released by the background task
+                else:
+                    await handler(query, context)
+            
+            else:
+                # Per-user buttons ("status_<id>", "create_proxy_<id>") route on the part before the ID
+                handler = self._callback_prefix_routes.get(callback_data.rpartition('_')[0])
+                if handler:
+                    await handler(query, context)
+        finally:
+            if op_lock is not None:
+                op_lock.release()
+    
+    def _is_duplicate_callback(self, query_id: str) -> bool:
+        """Check whether this callback query was already handled (redelivered update)"""
+        if query_id in self._seen_callbacks:
+            return True
+        self._seen_callbacks[query_id] = None
+        if len(self._seen_callbacks) > self.seen_callbacks_size:
+            self._seen_callbacks.popitem(last=False)
+        return False
+    
+    async def _release_after(self, coro, lock):
+        """Await coro, then release lock (if any)"""
+        try:
+            await coro
+        finally:
+            if lock is not None:
+                lock.release()
+    
+    async def _show_status_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
+        """Show the user's proxy status via callback query"""
+        user_id = query.from_user.id
+        user_data = await asyncio.to_thread(self.db.get_user, user_id)
+        if user_data and user_data['is_active']:
+            reply_markup = self._status_keyboard(user_id)
             
             await query.edit_message_text(
-                f"{self.t('detailed_help_title')}\n\n"
-                f"{self.t('detailed_step1')}\n"
-                f"{self.t('detailed_step2')}\n"
-                f"{self.t('detailed_step3')}\n"
-                f"{self.t('detailed_step4')}\n"
-                f"{self.t('detailed_step5')}\n\n"
-                f"{self.t('help_security')}\n"
-                f"{self.t('help_unique')}\n"
-                f"{self.t('help_no_share')}\n"
-                f"{self.t('help_stay_channel')}\n\n"
-                f"{self.t('help_commands')}\n"
-                f"{self.t('help_menu')}\n"
-                f"{self.t('help_start')}",
+                f"{self.t('proxy_status_title')}\n\n"
+                f"{self.t('status_active')}\n"
+                f"{self.t('created_date', date=user_data['created_at'])}\n"
+                f"{self.t('username_label', username=escape_markdown(str(user_data['username'])))}\n\n"
+                f"{self.t('tip_stay_active')}",
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
+        else:
+            await query.edit_message_text(self.t('no_active_proxy'))
+    
+    async def _show_help_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
+        """Show detailed help via callback query"""
+        reply_markup = self._back_to_menu_keyboard('btn_back_menu')
         
-        elif callback_data == "admin_pin_menu":
-            # Admin: Create channel pin menu
-            if await self.is_channel_admin(context, user_id):
-                await self._handle_admin_pin_callback(query, context)
-            else:
-                await query.edit_message_text(self.t('access_denied'))
-        
-        elif callback_data == "admin_unpin_all":
-            # Admin: Unpin all messages
-            if await self.is_channel_admin(context, user_id):
-                await self._handle_admin_unpin_callback(query, context)
-            else:
-                await query.edit_message_text(self.t('access_denied'))
-        
-        elif callback_data == "admin_stats":
-            # Admin: Show stats
-            if await self.is_channel_admin(context, user_id):
-                await self._handle_admin_stats_callback(query, context)
-            else:
-                await query.edit_message_text(self.t('access_denied'))
-        
-        elif callback_data == "admin_restart_proxy":
-            # Admin: Restart MTProxy
-            if await self.is_channel_admin(context, user_id):
-                await self._handle_admin_restart_proxy_callback(query, context)
-            else:
-                await query.edit_message_text(self.t('access_denied'))
-        
-        elif callback_data == "admin_reboot_vps":
-            # Admin: Reboot VPS
-            if await self.is_channel_admin(context, user_id):
-                await self._handle_admin_reboot_vps_callback(query, context)
-            else:
-                await query.edit_message_text(self.t('access_denied'))
-        
-        elif callback_data == "admin_reboot_confirm":
-            # Admin: Confirm VPS reboot
-            if await self.is_channel_admin(context, user_id):
-                await self._handle_admin_reboot_confirm_callback(query, context)
-            else:
-                await query.edit_message_text(self.t('access_denied'))
-        
-        elif callback_data == "back_to_menu":
-            # Go back to main menu
-            await self._show_main_menu_callback(query, context)
+        await query.edit_message_text(
+            self._detailed_help_text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
     
     async def _handle_admin_pin_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin pin menu callback"""
         try:
-            # Get bot username for links
-            bot_info = await context.bot.get_me()
-            bot_username = bot_info.username
+            # Get bot username for links (cached by the Bot since initialize)
+            bot_username = context.bot.username
             
-            # Create single button for proxy access
-            keyboard = [
-                [InlineKeyboardButton("🔗 دریافت پروکسی", url=f"https://t.me/{bot_username}?start=proxy")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Message text in Persian
-            menu_text = (
-                "🔗 **دریافت پروکسی رایگان MTProxy**\n\n"
-                "🎁 **برای اعضای کانال کاملاً رایگان!**\n\n"
-                "📱 **نحوه دریافت:**\n"
-                "👆 روی دکمه 'دریافت پروکسی' کلیک کنید\n\n"
-                "⚠️ **مهم:** فقط اعضای کانال پروکسی دریافت می‌کنند\n"
-                "🔒 **امنیت:** پروکسی خود را با دیگران به اشتراک نگذارید"
-            )
+            # Single button for proxy access (built once per bot username)
+            reply_markup = self._pin_menu_keyboard(bot_username)
             
-            # Get channel ID
-            channel_id = self.config.CHANNEL_ID
-            if channel_id.startswith('@'):
-                chat = await context.bot.get_chat(channel_id)
-                channel_chat_id = chat.id
-            else:
-                channel_chat_id = int(channel_id)
+            # Get channel ID (resolved once, then cached)
+            channel_chat_id = await self.get_channel_chat_id(context)
             
             # Send message with buttons to channel
             message = await context.bot.send_message(
                 chat_id=channel_chat_id,
-                text=menu_text,
+                text=_PIN_MENU_TEXT,
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
             
-            # Pin the message
+            # Pin the message; only confirm to the admin once the pin went through
             await context.bot.pin_chat_message(
                 chat_id=channel_chat_id,
                 message_id=message.message_id,
                 disable_notification=True
             )
-            
-            # Update admin message
             await query.edit_message_text(
                 f"✅ پیام دسترسی سریع ایجاد شد!\n\n"
                 f"📌 پیام در کانال پین شد\n"
@@ -830,10 +1428,10 @@ WantedBy=multi-user.target"""
                 f"شناسه پیام: {message.message_id}"
             )
             
-            logger.info(f"✅ Channel menu created and pinned via callback")
+            logger.info("✅ Channel menu created and pinned via callback")
             
         except Exception as e:
-            logger.error(f"❌ Error in admin pin callback: {e}")
+            logger.error("❌ Error in admin pin callback: %s", e)
             await query.edit_message_text(
                 f"❌ خطا در ایجاد پیام کانال:\n\n"
                 f"{str(e)}\n\n"
@@ -846,13 +1444,8 @@ WantedBy=multi-user.target"""
     async def _handle_admin_unpin_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin unpin all messages callback"""
         try:
-            # Get channel ID
-            channel_id = self.config.CHANNEL_ID
-            if channel_id.startswith('@'):
-                chat = await context.bot.get_chat(channel_id)
-                channel_chat_id = chat.id
-            else:
-                channel_chat_id = int(channel_id)
+            # Get channel ID (resolved once, then cached)
+            channel_chat_id = await self.get_channel_chat_id(context)
             
             # Unpin all messages
             await context.bot.unpin_all_chat_messages(chat_id=channel_chat_id)
@@ -865,10 +1458,10 @@ WantedBy=multi-user.target"""
                 f"کانال: {self.config.CHANNEL_ID}"
             )
             
-            logger.info(f"✅ All pinned messages unpinned via callback")
+            logger.info("✅ All pinned messages unpinned via callback")
             
         except Exception as e:
-            logger.error(f"❌ Error in admin unpin callback: {e}")
+            logger.error("❌ Error in admin unpin callback: %s", e)
             await query.edit_message_text(
                 f"❌ خطا در حذف پین پیام‌ها:\n\n"
                 f"{str(e)}\n\n"
@@ -878,83 +1471,82 @@ WantedBy=multi-user.target"""
                 f"• شناسه کانال صحیح باشد"
             )
     
+    async def _get_active_user_count(self) -> int:
+        """Count active users, reusing the result for active_count_ttl seconds"""
+        now = time.time()
+        if now - self._active_count_fetched_at >= self.active_count_ttl:
+            self._active_count = await asyncio.to_thread(self.db.count_active_users)
+            self._active_count_fetched_at = now
+        return self._active_count
+    
     async def _handle_admin_stats_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin stats callback"""
-        total_users = len(self.db.get_all_active_users())
-        uptime = time.time() - getattr(self, 'start_time', time.time())
-        
-        stats_text = (
-            f"📊 **آمار ربات**\n\n"
-            f"👥 **کاربران:** {total_users} فعال\n"
-            f"📈 **فعالیت:**\n"
-            f"   • عضویت: {self.stats['joins']}\n"
-            f"   • خروج: {self.stats['leaves']}\n"
-            f"   • پروکسی ایجاد شده: {self.stats['proxies_created']}\n"
-            f"   • پروکسی حذف شده: {self.stats['proxies_removed']}\n\n"
-            f"⚠️ **مشکلات:**\n"
-            f"   • خطاها: {self.stats['errors']}\n"
-            f"   • محدود شده: {self.stats['rate_limited']}\n\n"
-            f"⏱️ **مدت کار:** {uptime/3600:.1f} ساعت\n"
-            f"🔄 **آخرین ریستارت MTProxy:** {time.time() - self.last_mtproxy_restart:.1f}s پیش"
+        total_users = await self._get_active_user_count()
+        uptime = time.monotonic() - getattr(self, 'start_time', time.monotonic())
+        
+        stats_text = _STATS_TEMPLATE_FA.format(
+            total_users=total_users,
+            uptime_hours=uptime / 3600,
+            since_restart=time.time() - self.last_mtproxy_restart,
+            **self.stats.as_dict()
         )
         
-        keyboard = [[InlineKeyboardButton(self.t('btn_back'), callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._back_to_menu_keyboard('btn_back')
         
         await query.edit_message_text(stats_text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def _handle_admin_restart_proxy_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin restart proxy callback"""
+        # Send initial message while the stop is already underway
+        progress = asyncio.create_task(query.edit_message_text("🔄 در حال راه‌اندازی مجدد سرویس MTProxy..."))
         try:
-            # Send initial message
-            await query.edit_message_text("🔄 در حال راه‌اندازی مجدد سرویس MTProxy...")
-            
-            # Stop MTProxy service
-            stop_result = subprocess.run(['systemctl', 'stop', 'MTProxy'], 
-                                       capture_output=True, text=True, timeout=30)
-            
-            # Wait a moment
-            await asyncio.sleep(2)
-            
-            # Start MTProxy service
-            start_result = subprocess.run(['systemctl', 'start', 'MTProxy'], 
-                                        capture_output=True, text=True, timeout=30)
+            # Not while a secret batch is being applied
+            async with self.operation_lock:
+                # Stop MTProxy service
+                stop_result = await self._run_command('systemctl', 'stop', 'MTProxy', timeout=30, capture_stdout=False)
+                
+                # Wait a moment
+                await asyncio.sleep(2)
+                
+                # Start MTProxy service
+                start_result = await self._run_command('systemctl', 'start', 'MTProxy', timeout=30, capture_stdout=False)
+                
+                # Check service status
+                status_result = await self._run_command('systemctl', 'is-active', 'MTProxy', timeout=10, capture_stderr=False)
             
-            # Check service status
-            status_result = subprocess.run(['systemctl', 'is-active', 'MTProxy'], 
-                                         capture_output=True, text=True, timeout=10)
+            # The progress edit must land before the final one
+            await asyncio.gather(progress, return_exceptions=True)
             
-            keyboard = [[InlineKeyboardButton(self.t('btn_back'), callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = self._back_to_menu_keyboard('btn_back')
             
             if status_result.returncode == 0 and status_result.stdout.strip() == 'active':
                 await query.edit_message_text(
                     "✅ **راه‌اندازی مجدد MTProxy موفق**\n\n"
-                    f"🔄 سرویس توسط ادمین راه‌اندازی شد: @{query.from_user.username or 'Unknown'}\n"
-                    f"⏰ زمان: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                    f"🔄 سرویس توسط ادمین راه‌اندازی شد: @{escape_markdown(query.from_user.username or 'Unknown')}\n"
+                    f"⏰ زمان: {_now_str()}\n"
                     f"📊 وضعیت: فعال\n\n"
                     f"همه پروکسی‌های کاربران باید به طور عادی کار کنند.",
                     reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
-                logger.info(f"✅ MTProxy restarted successfully via callback by admin {query.from_user.id}")
+                logger.info("✅ MTProxy restarted successfully via callback by admin %s", query.from_user.id)
                 self.last_mtproxy_restart = time.time()
             else:
                 error_info = f"Stop: {stop_result.stderr}\nStart: {start_result.stderr}" if (stop_result.stderr or start_result.stderr) else "خطای نامشخص"
                 await query.edit_message_text(
                     "❌ **راه‌اندازی مجدد MTProxy ناموفق**\n\n"
                     f"⚠️ سرویس ممکن است به درستی کار نکند\n"
-                    f"📝 جزئیات خطا: {error_info[:200]}...\n\n"
+                    f"📝 جزئیات خطا: {escape_markdown(error_info[:200])}...\n\n"
                     f"لطفاً سرویس را به صورت دستی بررسی کنید:\n"
                     f"`systemctl status MTProxy`",
                     reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
-                logger.error(f"❌ MTProxy restart failed via callback by admin {query.from_user.id}: {error_info}")
+                logger.error("❌ MTProxy restart failed via callback by admin %s: %s", query.from_user.id, error_info)
                 
         except subprocess.TimeoutExpired:
-            keyboard = [[InlineKeyboardButton(self.t('btn_back'), callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            await asyncio.gather(progress, return_exceptions=True)
+            reply_markup = self._back_to_menu_keyboard('btn_back')
             await query.edit_message_text(
                 "⏰ **زمان راه‌اندازی مجدد MTProxy تمام شد**\n\n"
                 "عملیات راه‌اندازی مجدد زمان زیادی برد. لطفاً به صورت دستی بررسی کنید:\n"
@@ -962,28 +1554,24 @@ WantedBy=multi-user.target"""
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
-            logger.error(f"❌ MTProxy restart timeout via callback by admin {query.from_user.id}")
+            logger.error("❌ MTProxy restart timeout via callback by admin %s", query.from_user.id)
         except Exception as e:
-            keyboard = [[InlineKeyboardButton(self.t('btn_back'), callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            await asyncio.gather(progress, return_exceptions=True)
+            reply_markup = self._back_to_menu_keyboard('btn_back')
             await query.edit_message_text(
                 f"❌ **خطا در راه‌اندازی مجدد MTProxy**\n\n"
-                f"خطای غیرمنتظره: {str(e)[:200]}\n\n"
+                f"خطای غیرمنتظره: {escape_markdown(str(e)[:200])}\n\n"
                 f"لطفاً سرویس را به صورت دستی بررسی کنید:\n"
                 f"`systemctl status MTProxy`",
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
-            logger.error(f"❌ MTProxy restart error via callback by admin {query.from_user.id}: {e}")
+            logger.error("❌ MTProxy restart error via callback by admin %s: %s", query.from_user.id, e)
 
     async def _handle_admin_reboot_vps_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin reboot VPS callback"""
         # Show confirmation dialog
-        keyboard = [
-            [InlineKeyboardButton(self.t('btn_confirm_reboot'), callback_data="admin_reboot_confirm")],
-            [InlineKeyboardButton(self.t('btn_cancel'), callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._reboot_confirm_keyboard()
         
         await query.edit_message_text(
             self.t('admin_reboot_vps_confirm_dialog'),
@@ -991,54 +1579,68 @@ WantedBy=multi-user.target"""
             parse_mode='Markdown'
         )
 
+    async def _edit_reboot_status(self, edit, text):
+        """Best-effort status edit during the reboot countdown"""
+        try:
+            await edit(text, parse_mode='Markdown')
+        except Exception as e:
+            logger.warning("⚠️ Reboot status update failed: %s", e)
+    
     async def _handle_admin_reboot_confirm_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin reboot VPS confirmation callback"""
+        final_warning = None
         try:
-            # Send warning message
-            await query.edit_message_text(
+            # Countdown deadlines are fixed up front so edit round-trips don't stretch them
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            
+            # Send warning message (a failed edit must not cancel the reboot)
+            await self._edit_reboot_status(
+                query.edit_message_text,
                 "🚨 **راه‌اندازی مجدد سرور آغاز شد**\n\n"
-                f"👤 ادمین: @{query.from_user.username or 'Unknown'}\n"
-                f"⏰ زمان: {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+                f"👤 ادمین: @{escape_markdown(query.from_user.username or 'Unknown')}\n"
+                f"⏰ زمان: {_now_str()}\n\n"
                 "⚠️ سرور در ۱۰ ثانیه راه‌اندازی مجدد خواهد شد...\n"
                 "🔄 همه سرویس‌ها به صورت خودکار راه‌اندازی خواهند شد\n"
-                "⏱️ زمان تخمینی قطعی: ۲-۵ دقیقه",
-                parse_mode='Markdown'
+                "⏱️ زمان تخمینی قطعی: ۲-۵ دقیقه"
             )
             
-            logger.warning(f"🚨 VPS REBOOT initiated via callback by admin {query.from_user.id} (@{query.from_user.username})")
+            logger.warning("🚨 VPS REBOOT initiated via callback by admin %s (@%s)", query.from_user.id, query.from_user.username)
             
-            # Wait 10 seconds to allow message to be sent
-            await asyncio.sleep(10)
+            # Wait out the 10 second warning window
+            await asyncio.sleep(max(0, started + 10 - loop.time()))
             
-            # Final warning
-            await query.edit_message_text(
+            # Final warning, sent in the background while the last 2 seconds run down
+            final_warning = asyncio.create_task(self._edit_reboot_status(
+                query.edit_message_text,
                 "🚨 **در حال راه‌اندازی مجدد...**\n\n"
                 "سرور در حال خاموش شدن است.\n"
-                "ربات پس از راه‌اندازی مجدد آنلاین خواهد شد.",
-                parse_mode='Markdown'
-            )
+                "ربات پس از راه‌اندازی مجدد آنلاین خواهد شد."
+            ))
             
-            # Wait a moment for message to be sent
-            await asyncio.sleep(2)
+            await asyncio.sleep(max(0, started + 12 - loop.time()))
             
             # Execute reboot command
-            subprocess.run(['systemctl', 'reboot'], timeout=5)
-            
-        except subprocess.TimeoutExpired:
-            # This is expected as the system will reboot
+            await self._spawn_reboot()
             logger.info("Reboot command executed via callback, system shutting down...")
+            await final_warning
+            
+        except asyncio.CancelledError:
+            # Shutting down before the reboot: don't announce one
+            if final_warning is not None:
+                final_warning.cancel()
+            raise
         except Exception as e:
-            keyboard = [[InlineKeyboardButton(self.t('btn_back'), callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = self._back_to_menu_keyboard('btn_back')
             await query.edit_message_text(
                 f"❌ **راه‌اندازی مجدد ناموفق**\n\n"
-                f"خطا: {str(e)[:200]}\n\n"
+                f"خطا: {escape_markdown(str(e)[:200])}\n\n"
                 f"لطفاً به صورت دستی بررسی کنید یا از دستور زیر استفاده کنید:\n"
                 f"`sudo reboot`",
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
-            logger.error(f"❌ VPS reboot failed via callback by admin {query.from_user.id}: {e}")
+            logger.error("❌ VPS reboot failed via callback by admin %s: %s", query.from_user.id, e)
 
     async def _provide_proxy_via_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Provide proxy via callback query"""
@@ -1046,113 +1648,65 @@ WantedBy=multi-user.target"""
         
         # Check if user is in channel
         try:
-            member = await context.bot.get_chat_member(self.config.CHANNEL_ID, user.id)
-            if member.status not in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            status = await self._get_cached_status(context, user.id)
+            if status not in _PRESENT_STATUSES:
                 await query.edit_message_text(self.t('must_join_first'))
                 return
         except Exception as e:
             await query.edit_message_text(self.t('error_membership'))
             return
         
-        # Create proxy
-        existing_user = self.db.get_user(user.id)
+        # Create proxy (or reuse the active one)
+        created, error_key = await self._ensure_proxy(user.id, user.username or f"user_{user.id}")
+        if error_key:
+            await query.edit_message_text(self.t(error_key))
+            return
         
-        if existing_user and existing_user['is_active']:
-            keyboard = [[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user.id}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                self.t('proxy_ready'),
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        else:
-            secret = self.generate_secret()
-            
-            if await self.add_secret(secret):
-                username = user.username or f"user_{user.id}"
-                if self.db.add_user(user.id, username, secret):
-                    keyboard = [[InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user.id}")]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await query.edit_message_text(
-                        self.t('new_proxy_created'),
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await query.edit_message_text(self.t('error_saving'))
-            else:
-                await query.edit_message_text(self.t('error_creating'))
+        reply_markup = self._get_proxy_keyboard(user.id)
+        await query.edit_message_text(
+            self.t('new_proxy_created' if created else 'proxy_ready'),
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
     
     async def _show_main_menu_callback(self, query, context: ContextTypes.DEFAULT_TYPE):
         """Show main menu via callback query"""
         user = query.from_user
         
-        # Check if user is in channel
+        # Check if user is in channel while loading their record
         try:
-            member = await context.bot.get_chat_member(self.config.CHANNEL_ID, user.id)
-            if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            status, user_data = await asyncio.gather(
+                self._get_cached_status(context, user.id),
+                asyncio.to_thread(self.db.get_user, user.id)
+            )
+            if status in _PRESENT_STATUSES:
                 # User is in channel - show proxy options
-                user_data = self.db.get_user(user.id)
-                
-                if user_data and user_data['is_active']:
-                    keyboard = [
-                        [InlineKeyboardButton(self.t('btn_get_proxy'), callback_data=f"get_proxy_{user.id}")],
-                        [InlineKeyboardButton(self.t('btn_proxy_status'), callback_data=f"status_{user.id}")],
-                        [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
-                    ]
-                else:
-                    keyboard = [
-                        [InlineKeyboardButton(self.t('btn_create_proxy'), callback_data=f"create_proxy_{user.id}")],
-                        [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
-                    ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = self._main_menu_keyboard(user.id, bool(user_data and user_data['is_active']), False)
                 await query.edit_message_text(
                     f"{self.t('menu_title')}\n\n"
-                    f"{self.t('menu_welcome', name=user.first_name)}",
+                    f"{self.t('menu_welcome', name=escape_markdown(user.first_name))}",
                     reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
             else:
                 # User not in channel
-                keyboard = [
-                    [InlineKeyboardButton(self.t('btn_join_channel'), url=f"https://t.me/{self.config.CHANNEL_USERNAME}")],
-                    [InlineKeyboardButton(self.t('btn_help'), callback_data="help")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = self._join_channel_keyboard(True)
                 
                 await query.edit_message_text(
-                    f"{self.t('access_required')}\n\n"
-                    f"{self.t('join_first')}\n\n"
-                    f"{self.t('auto_receive')}",
+                    self._access_required_text,
                     reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
         except Exception as e:
-            logger.error(f"Error in menu callback: {e}")
+            logger.error("Error in menu callback: %s", e)
             await query.edit_message_text(self.t('error_membership'))
     
     async def show_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show help information"""
-        keyboard = [[InlineKeyboardButton(self.t('btn_main_menu'), callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._back_to_menu_keyboard('btn_main_menu')
         
         await update.message.reply_text(
-            f"{self.t('help_title')}\n\n"
-            f"{self.t('help_quick_start')}\n"
-            f"{self.t('help_step1')}\n"
-            f"{self.t('help_step2')}\n\n"
-            f"{self.t('help_commands')}\n"
-            f"{self.t('help_start')}\n"
-            f"{self.t('help_menu')}\n"
-            f"{self.t('help_help')}\n\n"
-            f"{self.t('help_security')}\n"
-            f"{self.t('help_unique')}\n"
-            f"{self.t('help_no_share')}\n"
-            f"{self.t('help_stay_channel')}\n\n"
-            f"{self.t('help_tip_menu')}",
+            self._help_text,
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
@@ -1167,50 +1721,29 @@ WantedBy=multi-user.target"""
             return
         
         try:
-            # Get bot username for links
-            bot_info = await context.bot.get_me()
-            bot_username = bot_info.username
+            # Get bot username for links (cached by the Bot since initialize)
+            bot_username = context.bot.username
             
-            # Create single button for proxy access
-            keyboard = [
-                [InlineKeyboardButton("🔗 دریافت پروکسی", url=f"https://t.me/{bot_username}?start=proxy")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Message text in Persian
-            menu_text = (
-                "🔗 **دریافت پروکسی رایگان MTProxy**\n\n"
-                "🎁 **برای اعضای کانال کاملاً رایگان!**\n\n"
-                "📱 **نحوه دریافت:**\n"
-                "👆 روی دکمه 'دریافت پروکسی' کلیک کنید\n\n"
-                "⚠️ **مهم:** فقط اعضای کانال پروکسی دریافت می‌کنند\n"
-                "🔒 **امنیت:** پروکسی خود را با دیگران به اشتراک نگذارید"
-            )
+            # Single button for proxy access (built once per bot username)
+            reply_markup = self._pin_menu_keyboard(bot_username)
             
-            # Get channel ID
-            channel_id = self.config.CHANNEL_ID
-            if channel_id.startswith('@'):
-                chat = await context.bot.get_chat(channel_id)
-                channel_chat_id = chat.id
-            else:
-                channel_chat_id = int(channel_id)
+            # Get channel ID (resolved once, then cached)
+            channel_chat_id = await self.get_channel_chat_id(context)
             
             # Send message with buttons to channel
             message = await context.bot.send_message(
                 chat_id=channel_chat_id,
-                text=menu_text,
+                text=_PIN_MENU_TEXT,
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
             
-            # Pin the message
+            # Pin the message; only confirm to the admin once the pin went through
             await context.bot.pin_chat_message(
                 chat_id=channel_chat_id,
                 message_id=message.message_id,
                 disable_notification=True
             )
-            
-            # Confirm to admin
             await update.message.reply_text(
                 f"✅ پیام دسترسی سریع ایجاد شد!\n\n"
                 f"📌 پیام در کانال پین شد\n"
@@ -1220,10 +1753,10 @@ WantedBy=multi-user.target"""
                 f"شناسه پیام: {message.message_id}"
             )
             
-            logger.info(f"✅ Channel menu created and pinned by admin {user_id}")
+            logger.info("✅ Channel menu created and pinned by admin %s", user_id)
             
         except Exception as e:
-            logger.error(f"❌ Error creating channel menu: {e}")
+            logger.error("❌ Error creating channel menu: %s", e)
             await update.message.reply_text(
                 f"❌ خطا در ایجاد پیام کانال:\n\n"
                 f"{str(e)}\n\n"
@@ -1243,13 +1776,8 @@ WantedBy=multi-user.target"""
             return
         
         try:
-            # Get channel ID
-            channel_id = self.config.CHANNEL_ID
-            if channel_id.startswith('@'):
-                chat = await context.bot.get_chat(channel_id)
-                channel_chat_id = chat.id
-            else:
-                channel_chat_id = int(channel_id)
+            # Get channel ID (resolved once, then cached)
+            channel_chat_id = await self.get_channel_chat_id(context)
             
             # Unpin all messages
             await context.bot.unpin_all_chat_messages(chat_id=channel_chat_id)
@@ -1262,10 +1790,10 @@ WantedBy=multi-user.target"""
                 f"کانال: {self.config.CHANNEL_ID}"
             )
             
-            logger.info(f"✅ All pinned messages unpinned by admin {user_id}")
+            logger.info("✅ All pinned messages unpinned by admin %s", user_id)
             
         except Exception as e:
-            logger.error(f"❌ Error unpinning messages: {e}")
+            logger.error("❌ Error unpinning messages: %s", e)
             await update.message.reply_text(
                 f"❌ خطا در حذف پین پیام‌ها:\n\n"
                 f"{str(e)}\n\n"
@@ -1284,22 +1812,14 @@ WantedBy=multi-user.target"""
             await update.message.reply_text(self.t('access_denied'))
             return
         
-        total_users = len(self.db.get_all_active_users())
-        uptime = time.time() - getattr(self, 'start_time', time.time())
-        
-        stats_text = (
-            f"📊 **Bot Statistics**\n\n"
-            f"👥 **Users:** {total_users} active\n"
-            f"📈 **Activity:**\n"
-            f"   • Joins: {self.stats['joins']}\n"
-            f"   • Leaves: {self.stats['leaves']}\n"
-            f"   • Proxies created: {self.stats['proxies_created']}\n"
-            f"   • Proxies removed: {self.stats['proxies_removed']}\n\n"
-            f"⚠️ **Issues:**\n"
-            f"   • Errors: {self.stats['errors']}\n"
-            f"   • Rate limited: {self.stats['rate_limited']}\n\n"
-            f"⏱️ **Uptime:** {uptime/3600:.1f} hours\n"
-            f"🔄 **Last MTProxy restart:** {time.time() - self.last_mtproxy_restart:.1f}s ago"
+        total_users = await self._get_active_user_count()
+        uptime = time.monotonic() - getattr(self, 'start_time', time.monotonic())
+        
+        stats_text = _STATS_TEMPLATE_EN.format(
+            total_users=total_users,
+            uptime_hours=uptime / 3600,
+            since_restart=time.time() - self.last_mtproxy_restart,
+            **self.stats.as_dict()
         )
         
         await update.message.reply_text(stats_text, parse_mode='Markdown')
@@ -1317,45 +1837,38 @@ WantedBy=multi-user.target"""
             # Send initial message
             status_msg = await update.message.reply_text(self.t('admin_restart_proxy_progress'))
             
-            # Restart MTProxy with pid_max workaround
-            if await self._restart_mtproxy_service():
-                # Check service status
-                status_result = subprocess.run(['systemctl', 'is-active', 'MTProxy'], 
-                                             capture_output=True, text=True, timeout=10)
-                
-                if status_result.returncode == 0 and status_result.stdout.strip() == 'active':
-                    await status_msg.edit_text(
-                        self.t('admin_restart_proxy_success', 
-                               username=update.effective_user.username or 'Unknown',
-                               time=time.strftime('%Y-%m-%d %H:%M:%S')),
-                        parse_mode='Markdown'
-                    )
-                    logger.info(f"✅ MTProxy restarted successfully by admin {user_id}")
-                else:
-                    await status_msg.edit_text(
-                        self.t('admin_restart_proxy_failed', error="Service not active after restart"),
-                        parse_mode='Markdown'
-                    )
-                    logger.error(f"❌ MTProxy restart failed by admin {user_id}: Service not active")
+            # Restart MTProxy with pid_max workaround (not while a secret batch is being applied)
+            async with self.operation_lock:
+                restarted = await self._restart_mtproxy_service()
+            
+            # _restart_mtproxy_service only succeeds once systemd reports the unit active
+            if restarted:
+                await status_msg.edit_text(
+                    self.t('admin_restart_proxy_success', 
+                           username=escape_markdown(update.effective_user.username or 'Unknown'),
+                           time=_now_str()),
+                    parse_mode='Markdown'
+                )
+                logger.info("✅ MTProxy restarted successfully by admin %s", user_id)
             else:
                 await status_msg.edit_text(
                     self.t('admin_restart_proxy_failed', error="Restart function failed"),
                     parse_mode='Markdown'
                 )
-                logger.error(f"❌ MTProxy restart failed by admin {user_id}: Restart function failed")
+                logger.error("❌ MTProxy restart failed by admin %s: Restart function failed", user_id)
                 
         except subprocess.TimeoutExpired:
             await status_msg.edit_text(
                 self.t('admin_restart_proxy_timeout'),
                 parse_mode='Markdown'
             )
-            logger.error(f"❌ MTProxy restart timeout by admin {user_id}")
+            logger.error("❌ MTProxy restart timeout by admin %s", user_id)
         except Exception as e:
             await status_msg.edit_text(
-                self.t('admin_restart_proxy_error', error=str(e)[:200]),
+                self.t('admin_restart_proxy_error', error=escape_markdown(str(e)[:200])),
                 parse_mode='Markdown'
             )
-            logger.error(f"❌ MTProxy restart error by admin {user_id}: {e}")
+            logger.error("❌ MTProxy restart error by admin %s: %s", user_id, e)
 
     async def reboot_vps(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Reboot VPS system (admin only) - DANGEROUS COMMAND"""
@@ -1374,100 +1887,197 @@ WantedBy=multi-user.target"""
             )
             return
         
+        # Single-flight with the reboot button: refuse while a reboot is already counting down
+        op_lock = self._admin_op_locks['admin_reboot_confirm']
+        if op_lock.locked():
+            await update.message.reply_text(self.t('admin_busy'))
+            return
+        await op_lock.acquire()  # Uncontended, so this does not yield
+        
         try:
             # Send warning message
             warning_msg = await update.message.reply_text(
                 self.t('admin_reboot_vps_initiated',
-                       username=update.effective_user.username or 'Unknown',
-                       time=time.strftime('%Y-%m-%d %H:%M:%S')),
+                       username=escape_markdown(update.effective_user.username or 'Unknown'),
+                       time=_now_str()),
                 parse_mode='Markdown'
             )
             
-            logger.warning(f"🚨 VPS REBOOT initiated by admin {user_id} (@{update.effective_user.username})")
+            logger.warning("🚨 VPS REBOOT initiated by admin %s (@%s)", user_id, update.effective_user.username)
             
-            # Wait 10 seconds to allow message to be sent
-            await asyncio.sleep(10)
+            # Run the countdown in the background and free the handler. A plain asyncio task,
+            # since Application.stop() awaits its own tasks and would let the reboot fire; post_stop cancels it
+            self._reboot_task = asyncio.create_task(
+                self._release_after(self._reboot_countdown(warning_msg, update.message, user_id), op_lock)
+            )
+            op_lock = None  # Released by the countdown task
             
-            # Final warning
-            await warning_msg.edit_text(
-                self.t('admin_reboot_vps_now'),
+        except Exception as e:
+            await update.message.reply_text(
+                self.t('admin_reboot_vps_failed', error=escape_markdown(str(e)[:200])),
                 parse_mode='Markdown'
             )
-            
-            # Wait a moment for message to be sent
-            await asyncio.sleep(2)
-            
-            # Execute reboot command
-            subprocess.run(['systemctl', 'reboot'], timeout=5)
-            
-        except subprocess.TimeoutExpired:
-            # This is expected as the system will reboot
+            logger.error("❌ VPS reboot failed by admin %s: %s", user_id, e)
+        finally:
+            if op_lock is not None:
+                op_lock.release()
+
+    async def _reboot_countdown(self, warning_msg, message, user_id):
+        """Send the final warning after 10 seconds, then reboot 2 seconds later"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        
+        final_warning = None
+        try:
+            await asyncio.sleep(10)
+            final_warning = asyncio.create_task(self._edit_reboot_status(
+                warning_msg.edit_text, self.t('admin_reboot_vps_now')))
+            
+            await asyncio.sleep(max(0, started + 12 - loop.time()))
+            await self._execute_reboot(message, user_id)
+            await final_warning
+        except asyncio.CancelledError:
+            # Shutting down before the reboot: don't announce one
+            if final_warning is not None:
+                final_warning.cancel()
+            raise
+
+    async def _execute_reboot(self, message, user_id):
+        """Start the reboot, reporting failures back to the admin"""
+        try:
+            await self._spawn_reboot()
             logger.info("Reboot command executed, system shutting down...")
         except Exception as e:
-            await update.message.reply_text(
-                self.t('admin_reboot_vps_failed', error=str(e)[:200]),
+            await message.reply_text(
+                self.t('admin_reboot_vps_failed', error=escape_markdown(str(e)[:200])),
                 parse_mode='Markdown'
             )
-            logger.error(f"❌ VPS reboot failed by admin {user_id}: {e}")
+            logger.error("❌ VPS reboot failed by admin %s: %s", user_id, e)
 
+    async def _save_stats(self):
+        """Persist stats counters if they changed since the last save"""
+        snapshot = self.stats.as_dict()
+        if snapshot != self._saved_stats:
+            if await asyncio.to_thread(self.db.save_stats, snapshot):
+                self._saved_stats = snapshot
+    
+    async def _flush_stats(self, interval=60):
+        """Periodically persist changed stats counters to the database"""
+        while True:
+            await asyncio.sleep(interval)
+            await self._save_stats()
+    
     async def post_init(self, application):
         """Setup menu button after bot starts"""
+        # Background housekeeping: bound the rate limit table, persist stats,
+        # and look up the public IP now so the first proxy link doesn't wait for it
+        self._housekeeping_tasks = [
+            asyncio.create_task(self._gc_rate_limits()),
+            asyncio.create_task(self._flush_stats()),
+            asyncio.create_task(self._get_public_ip()),
+        ]
+        
         try:
-            from telegram import MenuButtonCommands
-            
             # Set bot commands with translated descriptions
-            commands = [
-                ("start", self.t('cmd_start_desc')),
-                ("menu", self.t('cmd_menu_desc')),
-                ("help", self.t('cmd_help_desc')),
-                ("pin", self.t('cmd_pin_desc')),
-                ("unpin", self.t('cmd_unpin_desc')),
-                ("stats", self.t('cmd_stats_desc')),
-                ("restart_proxy", self.t('cmd_restart_proxy_desc')),
-                ("reboot_vps", self.t('cmd_reboot_vps_desc')),
-            ]
-            
-            await application.bot.set_my_commands(commands)
+            commands = [(name, self.t(f'cmd_{name}_desc')) for name, _, _ in _COMMANDS]
             
-            # Set menu button to show commands
+            # Set commands and the menu button that shows them in parallel
             # The "Menu" text will be in user's Telegram language automatically
             # The command descriptions will be in our configured language
-            await application.bot.set_chat_menu_button(
-                menu_button=MenuButtonCommands()
+            await asyncio.gather(
+                application.bot.set_my_commands(commands),
+                application.bot.set_chat_menu_button(menu_button=_MENU_BUTTON)
             )
             
             logger.info("✅ Menu button configured successfully")
             
         except Exception as e:
-            logger.error(f"❌ Error setting up menu button: {e}")
+            logger.error("❌ Error setting up menu button: %s", e)
+
+    async def post_stop(self, application):
+        """Cancel a pending reboot countdown as soon as the bot stops"""
+        if self._reboot_task is not None:
+            self._reboot_task.cancel()
+            await asyncio.gather(self._reboot_task, return_exceptions=True)
+
+    async def post_shutdown(self, application):
+        """Stop background tasks and save the final stats before exit"""
+        tasks = list(self._housekeeping_tasks)
+        if self._mtproxy_drainer is not None:
+            tasks.append(self._mtproxy_drainer)
+        if self._public_ip_lookup is not None:
+            tasks.append(self._public_ip_lookup)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        await self._save_stats()
+        logger.info("Bot stopped, stats saved")
 
     def run(self):
         """Start the bot"""
-        application = Application.builder().token(self.config.BOT_TOKEN).build()
+        # Prefer uvloop's faster event loop when it is installed
+        try:
+            import uvloop
+            uvloop.install()
+            logger.info("Using uvloop event loop")
+        except ImportError:
+            pass
+        
+        # PTB shares one pooled HTTPX client for all Bot API calls (getUpdates gets its own);
+        # let bursts of concurrent handlers wait for a free connection instead of failing after 1s
+        application = (
+            Application.builder()
+            .token(self.config.BOT_TOKEN)
+            .connection_pool_size(64)
+            .pool_timeout(5.0)
+            .rate_limiter(_BotRateLimiter())
+            .build()
+        )
         
         # Setup post-init callback for menu button
         application.post_init = self.post_init
+        application.post_stop = self.post_stop
+        application.post_shutdown = self.post_shutdown
         
-        application.add_handler(CommandHandler("start", self.start))
-        application.add_handler(CommandHandler("menu", self.menu))
-        application.add_handler(CommandHandler("help", self.show_help))
-        application.add_handler(CommandHandler("pin", self.pin_channel_menu))  # Admin-only pin command
-        application.add_handler(CommandHandler("unpin", self.unpin_channel_message))  # Admin-only unpin command
-        application.add_handler(CommandHandler("stats", self.show_stats))
-        application.add_handler(CommandHandler("restart_proxy", self.restart_mtproxy))  # Admin-only MTProxy restart
-        application.add_handler(CommandHandler("reboot_vps", self.reboot_vps))  # Admin-only VPS reboot
-        application.add_handler(CallbackQueryHandler(self.handle_proxy_callback, pattern="^get_proxy_"))
-        application.add_handler(CallbackQueryHandler(self.handle_menu_callbacks, pattern="^(status_|create_proxy_|help|back_to_menu|admin_)"))
-        application.add_handler(ChatMemberHandler(self.handle_member_update, ChatMemberHandler.CHAT_MEMBER))
+        # Handlers are tried in order, so the most frequent updates (button taps) come first
+        application.add_handlers([
+            CallbackQueryHandler(
+                self.handle_proxy_callback, pattern=lambda data: data.startswith(_PROXY_CALLBACK_PREFIX), block=False),
+            CallbackQueryHandler(
+                self.handle_menu_callbacks, pattern=lambda data: data.startswith(_MENU_CALLBACK_PREFIXES), block=False),
+            # Non-blocking so a burst of joins is batched into one MTProxy restart;
+            # per-user locks keep each user's join and leave in order
+            _ChannelMemberHandler(self.handle_member_update, self._is_target_channel, block=False),
+            *(CommandHandler(name, getattr(self, attr), block=block) for name, attr, block in _COMMANDS),
+        ])
         
         # Track start time for statistics
-        self.start_time = time.time()
+        self.start_time = time.monotonic()  # Monotonic, so uptime survives wall clock (NTP) jumps
         
         logger.info("Working MTProxy bot started with load management!")
-        logger.info(f"Monitoring channel: {self.config.CHANNEL_ID}")
+        logger.info("Monitoring channel: %s", self.config.CHANNEL_ID)
         logger.info("Features: Rate limiting, async operations, error handling")
-        logger.info("Bot will receive ALL update types including chat member updates")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("Bot will receive update types: %s", ', '.join(_ALLOWED_UPDATES))
+        if self.config.WEBHOOK_URL:
+            # Telegram pushes updates to us; the token in the path keeps the URL unguessable
+            logger.info("Receiving updates via webhook on port %s", self.config.WEBHOOK_PORT)
+            application.run_webhook(
+                listen=self.config.WEBHOOK_LISTEN,
+                port=self.config.WEBHOOK_PORT,
+                url_path=self.config.BOT_TOKEN,
+                webhook_url=f"{self.config.WEBHOOK_URL}/{self.config.BOT_TOKEN}",
+                secret_token=self.config.WEBHOOK_SECRET,
+                allowed_updates=_ALLOWED_UPDATES
+            )
+        else:
+            # Long-poll for up to 30s per getUpdates call (PTB adds this to the read timeout)
+            application.run_polling(
+                poll_interval=0,
+                timeout=30,
+                bootstrap_retries=-1,
+                allowed_updates=_ALLOWED_UPDATES
+            )
 
 if __name__ == "__main__":
     bot = WorkingMTProxyBot()
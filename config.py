@@ -13,6 +13,10 @@ class Config:
     SSH_KEY_PATH = os.getenv('SSH_KEY_PATH')
     MTPROXY_PATH = os.getenv('MTPROXY_PATH', '/opt/mtproto-proxy')
     MTPROXY_PORT = int(os.getenv('MTPROXY_PORT', 443))
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')  # Empty = long polling
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
     
     @classmethod
     def _normalize_channel_id(cls, channel_id: str) -> str:
@@ -48,19 +52,6 @@ class Config:
         # Add @ prefix for username format
         return f'@{channel_id}'
     
-    @property
-    def CHANNEL_ID(self) -> str:
-        """Get normalized channel ID"""
-        return self._normalize_channel_id(self._RAW_CHANNEL_ID)
-    
-    @property 
-    def CHANNEL_USERNAME(self) -> str:
-        """Get channel username without @ prefix for URL generation"""
-        channel_id = self.CHANNEL_ID
-        if channel_id and channel_id.startswith('@'):
-            return channel_id[1:]
-        return channel_id
-    
     @classmethod
     def validate(cls):
         # Check required config
@@ -86,4 +77,9 @@ class Config:
             if not normalized:
                 raise ValueError("CHANNEL_ID cannot be empty after normalization")
         except Exception as e:
-            raise ValueError(f"Invalid CHANNEL_ID format '{cls._RAW_CHANNEL_ID}': {e}")
\ No newline at end of file
+            raise ValueError(f"Invalid CHANNEL_ID format '{cls._RAW_CHANNEL_ID}': {e}")
+
+# Normalized once at import; these never change while the bot runs
+Config.CHANNEL_ID = Config._normalize_channel_id(Config._RAW_CHANNEL_ID)  # Normalized channel ID
+# Channel username without @ prefix for URL generation
+Config.CHANNEL_USERNAME = Config.CHANNEL_ID[1:] if Config.CHANNEL_ID and Config.CHANNEL_ID.startswith('@') else Config.CHANNEL_ID
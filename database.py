@@ -1,14 +1,32 @@
 import sqlite3
 import json
+import threading
 from typing import Optional, Dict, List
 
 class Database:
     def __init__(self, db_path: str = "bot_data.db"):
         self.db_path = db_path
+        self._local = threading.local()
         self.init_db()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Get this thread's persistent connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            # WAL (set in init_db) is durable with synchronous=NORMAL and lets reads run beside a write
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=134217728")
+            conn.execute("PRAGMA cache_size=-20000")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+    
     def init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # Persistent, stored in the database file
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -18,13 +36,27 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_is_active ON users (is_active)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stats (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            """)
             conn.commit()
     
     def add_user(self, user_id: int, username: str, secret: str) -> bool:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
+                # Upsert in place: keeps created_at, and skips the write when nothing changed
                 conn.execute(
-                    "INSERT OR REPLACE INTO users (user_id, username, secret, is_active) VALUES (?, ?, ?, 1)",
+                    """
+                    INSERT INTO users (user_id, username, secret, is_active) VALUES (?, ?, ?, 1)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = excluded.username, secret = excluded.secret, is_active = 1
+                    WHERE users.is_active = 0 OR users.secret IS NOT excluded.secret
+                        OR users.username IS NOT excluded.username
+                    """,
                     (user_id, username, secret)
                 )
                 conn.commit()
@@ -34,15 +66,14 @@ class Database:
             return False
     
     def get_user(self, user_id: int) -> Optional[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
     
     def deactivate_user(self, user_id: int) -> bool:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 conn.execute("UPDATE users SET is_active = 0 WHERE user_id = ?", (user_id,))
                 conn.commit()
                 return True
@@ -51,7 +82,29 @@ class Database:
             return False
     
     def get_all_active_users(self) -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.execute("SELECT * FROM users WHERE is_active = 1")
-            return [dict(row) for row in cursor.fetchall()]
\ No newline at end of file
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def count_active_users(self) -> int:
+        with self._connect() as conn:
+            cursor = conn.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
+            return cursor.fetchone()[0]
+    
+    def get_stats(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            cursor = conn.execute("SELECT key, value FROM stats")
+            return dict(cursor.fetchall())
+    
+    def save_stats(self, stats: Dict[str, int]) -> bool:
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+                    stats.items()
+                )
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error saving stats: {e}")
+            return False
\ No newline at end of file
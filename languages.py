@@ -100,6 +100,8 @@ LANGUAGES = {
         
         # Admin commands
         'access_denied': "❌ Access denied.",
+        'admin_working': "⏳ Working on it...",
+        'admin_busy': "⏳ This operation is already in progress.",
         'admin_restart_proxy_progress': "🔄 Restarting MTProxy service...",
         'admin_restart_proxy_success': "✅ **MTProxy Restart Successful**\n\n🔄 Service restarted by admin: @{username}\n⏰ Time: {time}\n📊 Status: Active\n\nAll user proxies should be working normally.",
         'admin_restart_proxy_failed': "❌ **MTProxy Restart Failed**\n\n⚠️ Service may not be running properly\n📝 Error details: {error}\n\nPlease check service manually:\n`systemctl status MTProxy`",
@@ -231,6 +233,8 @@ LANGUAGES = {
         
         # Admin commands
         'access_denied': "❌ دسترسی مجاز نیست.",
+        'admin_working': "⏳ در حال انجام...",
+        'admin_busy': "⏳ این عملیات در حال انجام است.",
         'admin_restart_proxy_progress': "🔄 در حال راه‌اندازی مجدد سرویس MTProxy...",
         'admin_restart_proxy_success': "✅ **راه‌اندازی مجدد MTProxy موفق**\n\n🔄 سرویس توسط ادمین راه‌اندازی شد: @{username}\n⏰ زمان: {time}\n📊 وضعیت: فعال\n\nهمه پروکسی‌های کاربران باید به طور عادی کار کنند.",
         'admin_restart_proxy_failed': "❌ **راه‌اندازی مجدد MTProxy ناموفق**\n\n⚠️ سرویس ممکن است به درستی کار نکند\n📝 جزئیات خطا: {error}\n\nلطفاً سرویس را به صورت دستی بررسی کنید:\n`systemctl status MTProxy`",
@@ -250,18 +254,20 @@ LANGUAGES = {
     }
 }
 
+# Per-language tables with English fallbacks merged in, so a lookup is a single dict access
+_RESOLVED = {language: {**LANGUAGES['en'], **texts} for language, texts in LANGUAGES.items()}
+
 def get_text(key: str, language: str = 'en', **kwargs) -> str:
     """Get translated text for the specified language"""
-    if language not in LANGUAGES:
-        language = 'en'  # Fallback to English
-    
-    text = LANGUAGES[language].get(key, LANGUAGES['en'].get(key, f"Missing: {key}"))
+    text = _RESOLVED.get(language, _RESOLVED['en']).get(key)
+    if text is None:
+        return f"Missing: {key}"
     
     # Format with provided arguments
     if kwargs:
         try:
-            text = text.format(**kwargs)
+            text = text.format_map(kwargs)
         except KeyError:
             pass  # Ignore missing format arguments
     
-    return text
\ No newline at end of file
+    return text
@@ -179,6 +179,8 @@ if [ ! -f "$SCRIPT_DIR/requirements.txt" ]; then
 python-telegram-bot==20.7
 paramiko==3.4.0
 python-dotenv==1.0.0
+httpx==0.25.2
+uvloop==0.19.0; sys_platform != "win32"
 EOF
 fi
 